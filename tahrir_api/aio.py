@@ -0,0 +1,232 @@
+""" Asynchronous API for interacting with the Tahrir database. """
+
+import logging
+import weakref
+from datetime import datetime, timezone
+
+from sqlalchemy import event
+
+from . import queries
+from .model import (
+    Assertion,
+    CurrentValue,
+    get_assertion_recipient,
+    Person,
+    salt_default,
+)
+from .utils import async_autocommit, get_async_db_manager_from_uri
+
+
+log = logging.getLogger(__name__)
+
+
+class AsyncTahrirDatabase:
+    """
+    Class for talking to the Tahrir database with asyncio
+
+    It mirrors the lookups, the badge awards, the leaderboard and the current
+    values of :class:`tahrir_api.dbapi.TahrirDatabase`, and builds the same
+    queries. Relationships are not loaded lazily with asyncio, so load the
+    ones you need explicitly.
+
+    Pass one or the other of the two parameters, but not both.
+
+    :type dburi: str
+    :param dburi: the sqlalchemy database URI, the asyncio driver of the
+        database (e.g. aiosqlite or asyncpg) is used.
+
+    :type session: SQLAlchemy AsyncSession object
+    :param session: an already configured session object.
+
+    :type notification_callback: callable
+    :param notification_callback: called with the notifications, after the
+        commit of the transaction which queued them.
+    """
+
+    def __init__(self, dburi=None, session=None, autocommit=True, notification_callback=None):
+        if not dburi and not session:
+            raise ValueError("You must provide either 'dburi' or 'session'")
+
+        if dburi and session:
+            raise ValueError("Provide only one, either 'dburi' or 'session'")
+
+        self.autocommit = autocommit
+
+        if dburi:
+            db_mgr = get_async_db_manager_from_uri(dburi)
+            self.session = db_mgr.Session()
+        else:
+            self.session = session
+
+        self.notification_callback = notification_callback
+        self._pending_notifications = []
+        self._listeners = []
+        self._listen("after_commit", "_after_commit")
+        self._listen("after_rollback", "_after_rollback")
+
+    def _listen(self, identifier, method_name):
+        """See :meth:`tahrir_api.dbapi.TahrirDatabase._listen`."""
+        ref = weakref.ref(self)
+
+        def listener(*args):
+            api = ref()
+            if api is not None:
+                getattr(api, method_name)(*args)
+
+        session = self.session.sync_session
+        event.listen(session, identifier, listener)
+        self._listeners.append(weakref.finalize(self, event.remove, session, identifier, listener))
+
+    def _notify(self, message):
+        if self.notification_callback:
+            self._pending_notifications.append(message)
+
+    def _after_commit(self, session):
+        messages, self._pending_notifications = self._pending_notifications, []
+        # Raising would break the session and drop the other messages, the
+        # failures are only logged.
+        for message in messages:
+            try:
+                self.notification_callback(message)
+            except Exception:
+                log.exception("Could not send the notification %r", message)
+
+    def _after_rollback(self, session):
+        self._pending_notifications = []
+
+    async def commit(self):
+        await self.session.commit()
+
+    async def rollback(self):
+        await self.session.rollback()
+
+    async def close(self):
+        for remove_listener in self._listeners:
+            remove_listener()
+        await self.session.close()
+
+    async def _exists(self, query):
+        return await self.session.scalar(queries.exists(query))
+
+    async def _first(self, query):
+        return (await self.session.scalars(query)).first()
+
+    async def team_exists(self, team_id):
+        return await self._exists(queries.team(team_id))
+
+    async def get_team(self, team_id):
+        return await self._first(queries.team(team_id))
+
+    async def series_exists(self, series_id):
+        return await self._exists(queries.series(series_id))
+
+    async def get_series(self, series_id):
+        return await self._first(queries.series(series_id))
+
+    async def badge_exists(self, badge_id):
+        return await self._exists(queries.badge(badge_id))
+
+    async def get_badge(self, badge_id):
+        return await self._first(queries.badge(badge_id))
+
+    async def get_issuer(self, issuer_id):
+        return await self._first(queries.issuer(issuer_id))
+
+    async def person_exists(self, email=None, id=None, nickname=None):
+        lookups = queries.person_lookups(email, id, nickname)
+        if not lookups:
+            return False
+        # Like the sync API, only the first given criterion is checked.
+        return await self._exists(lookups[0])
+
+    async def get_person(self, person_email=None, id=None, nickname=None):
+        # Each criterion is only tried if the previous ones didn't match.
+        for query in queries.person_lookups(person_email, id, nickname):
+            person = await self._first(query)
+            if person is not None:
+                return person
+        return None
+
+    async def person_opted_out(self, email=None, id=None, nickname=None):
+        person = await self.get_person(email, id, nickname)
+        return person.opt_out if person else False
+
+    async def get_assertions_by_email(self, person_email):
+        person = await self.get_person(person_email=person_email)
+        if person is None:
+            return False
+        return (await self.session.scalars(queries.assertions_of_person(person.id))).all()
+
+    @async_autocommit
+    async def add_person(self, email, nickname=None, website=None, bio=None, avatar=None):
+        if await self.person_exists(email=email):
+            return False
+        if not nickname:
+            nickname = email.split("@")[0]
+        self.session.add(
+            Person(email=email, nickname=nickname, website=website, bio=bio, _avatar=avatar)
+        )
+        await self.session.flush()
+        return email
+
+    @async_autocommit
+    async def add_assertion(self, badge_id, person_email, issued_on, issued_for=None):
+        if issued_on is None:
+            issued_on = datetime.now(timezone.utc)
+
+        person = await self.get_person(person_email)
+        badge = await self.get_badge(badge_id) if person is not None else None
+        if badge is None:
+            return False
+
+        salt = salt_default(None)
+        self.session.add(
+            Assertion(
+                badge_id=badge_id,
+                person_id=person.id,
+                salt=salt,
+                recipient=get_assertion_recipient(person.email, salt),
+                issued_on=issued_on,
+                issued_for=issued_for,
+            )
+        )
+        await self.session.flush()
+        self._notify(queries.badge_award_message(badge_id, badge, person))
+        return person_email, badge_id
+
+    async def get_current_value(self, badge_id, person_email):
+        if not await self.badge_exists(badge_id):
+            raise ValueError(f"No such badge {badge_id!r}")
+
+        person = await self.get_person(person_email=person_email)
+        if person is None:
+            return None
+
+        query = queries.current_value(badge_id, person.id)
+        return await self.session.scalar(query.with_only_columns(CurrentValue.value))
+
+    async def set_current_value(self, badge_id, person_email, value):
+        if not await self.badge_exists(badge_id):
+            raise ValueError(f"No such badge {badge_id!r}")
+
+        person = await self.get_person(person_email=person_email)
+        if person is None:
+            await self.add_person(email=person_email)
+            person = await self.get_person(person_email=person_email)
+
+        now = datetime.now(tz=timezone.utc)
+        current_value = await self.session.scalar(queries.current_value(badge_id, person.id))
+        if current_value is None:
+            current_value = CurrentValue(
+                badge_id=badge_id, person_id=person.id, value=value, last_update=now
+            )
+            self.session.add(current_value)
+            await self.session.flush()
+        else:
+            current_value.value = value
+            current_value.last_update = now
+
+    async def make_leaderboard(self, start=None, stop=None):
+        """See :meth:`tahrir_api.dbapi.TahrirDatabase.make_leaderboard`."""
+        leaderboard = (await self.session.execute(queries.leaderboard(start, stop))).all()
+        return queries.rank_leaderboard(leaderboard)
@@ -0,0 +1,273 @@
+""" Caching of database objects and query results. """
+
+import datetime
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import Date, DateTime, inspect
+from sqlalchemy.orm import attributes, make_transient_to_detached
+
+
+class LRUCache:
+    """
+    An in-process, thread-safe LRU cache whose entries expire after a delay.
+
+    :type maxsize: int
+    :param maxsize: The maximum number of entries, the least recently used
+        ones are evicted first.
+
+    :type ttl: float
+    :param ttl: The number of seconds after which an entry expires, or None
+        if entries never expire.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the value cached for this key, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and entry[0] <= self._clock():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            expires = self._clock() + self.ttl if self.ttl is not None else None
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    @property
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, size=len(self._entries))
+
+
+def detached_copy(obj):
+    """Return a detached copy of a model object's column attributes.
+
+    The copy can be shared between sessions, and added to any of them with
+    ``session.merge(copy, load=False)`` without emitting a query.
+    """
+    mapper = inspect(obj).mapper
+    return _detached(mapper, {attr.key: getattr(obj, attr.key) for attr in mapper.column_attrs})
+
+
+def _detached(mapper, values):
+    # The constructor and the validators are skipped: they could add
+    # related objects to the copy, which merge(load=False) refuses.
+    obj = mapper.class_manager.new_instance()
+    for key, value in values.items():
+        attributes.set_committed_value(obj, key, value)
+    make_transient_to_detached(obj)
+    return obj
+
+
+def dump_objects(objs):
+    """Return the column attributes of model objects as JSON-serializable dicts."""
+    rows = []
+    for obj in objs:
+        row = {}
+        for attr in inspect(obj).mapper.column_attrs:
+            value = getattr(obj, attr.key)
+            if isinstance(value, (datetime.date, datetime.datetime)):
+                value = value.isoformat()
+            row[attr.key] = value
+        rows.append(row)
+    return rows
+
+
+def load_objects(cls, rows):
+    """Return detached model objects from the dicts made by :func:`dump_objects`."""
+    mapper = inspect(cls)
+    parsers = {}
+    for attr in mapper.column_attrs:
+        column_type = attr.columns[0].type
+        if isinstance(column_type, DateTime):
+            parsers[attr.key] = datetime.datetime.fromisoformat
+        elif isinstance(column_type, Date):
+            parsers[attr.key] = datetime.date.fromisoformat
+    return [
+        _detached(
+            mapper,
+            {
+                key: parsers[key](value) if key in parsers and value is not None else value
+                for key, value in row.items()
+            },
+        )
+        for row in rows
+    ]
+
+
+class CacheBackend:
+    """
+    The interface of the caches shared between processes.
+
+    Keys and values are strings. Backends should fail open: when the cache
+    is unavailable, ``get()`` returns None and writes are ignored.
+    """
+
+    def get(self, key):
+        """Return the value stored for this key, or None."""
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        """Store a value, for ``ttl`` seconds if given."""
+        raise NotImplementedError
+
+    def incr(self, key):
+        """Increment the integer stored for this key, starting at 0, and return it."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+
+class MemoryBackend(CacheBackend):
+    """
+    A cache backend storing the values in memory.
+
+    It is only shared within the process, and is mostly useful for tests and
+    single-process deployments.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            expires, value = self._values.get(key, (None, None))
+            if expires is not None and expires <= self._clock():
+                del self._values[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            expires = self._clock() + ttl if ttl else None
+            self._values[key] = (expires, value)
+
+    def incr(self, key):
+        with self._lock:
+            expires, value = self._values.get(key, (None, "0"))
+            value = str(int(value) + 1)
+            self._values[key] = (expires, value)
+            return int(value)
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+
+class MemcachedBackend(CacheBackend):
+    """
+    A cache backend talking to a server over the memcached text protocol.
+
+    Any server speaking this protocol can be used (memcached, or the
+    memcached interfaces of other key/value stores). The connection is
+    opened lazily and reopened after network errors, which are otherwise
+    treated as cache misses.
+
+    :type host: str
+    :param host: The server's host name
+
+    :type port: int
+    :param port: The server's port
+
+    :type timeout: float
+    :param timeout: The socket timeout in seconds
+    """
+
+    def __init__(self, host="localhost", port=11211, timeout=1.0):
+        self.address = (host, port)
+        self.timeout = timeout
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _command(self, command, data=None, retrieval=False):
+        """Send a command and return the lines of its response, or None on errors."""
+        with self._lock:
+            try:
+                if self._connection is None:
+                    sock = socket.create_connection(self.address, timeout=self.timeout)
+                    self._connection = (sock, sock.makefile("rb"))
+                sock, reader = self._connection
+                payload = command.encode("utf-8") + b"\r\n"
+                if data is not None:
+                    payload += data + b"\r\n"
+                sock.sendall(payload)
+                response = [self._readline(reader)]
+                # Retrieval commands send each value after its VALUE line, and
+                # end with END.
+                while retrieval and response[-1].startswith(b"VALUE "):
+                    size = int(response[-1].split()[3])
+                    response.append(reader.read(size + 2)[:size])
+                    response.append(self._readline(reader))
+                return response
+            except OSError:
+                self._close()
+                return None
+
+    def _readline(self, reader):
+        line = reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise OSError("Connection closed by the cache server")
+        return line[:-2]
+
+    def _close(self):
+        if self._connection is not None:
+            sock, reader = self._connection
+            reader.close()
+            sock.close()
+            self._connection = None
+
+    def get(self, key):
+        response = self._command(f"get {key}", retrieval=True)
+        if not response or len(response) < 3:
+            return None
+        return response[1].decode("utf-8")
+
+    def set(self, key, value, ttl=None):
+        data = value.encode("utf-8")
+        self._command(f"set {key} 0 {int(ttl or 0)} {len(data)}", data)
+
+    def incr(self, key):
+        response = self._command(f"incr {key} 1")
+        if response and response[0] == b"NOT_FOUND":
+            self._command(f"add {key} 0 0 1", b"0")
+            response = self._command(f"incr {key} 1")
+        if not response or not response[0].isdigit():
+            return None
+        return int(response[0])
+
+    def delete(self, key):
+        self._command(f"delete {key}")
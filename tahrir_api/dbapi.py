@@ -2,25 +2,107 @@
 #          Remy D <remyd@civx.us>
 # Description: API For interacting with the Tahrir database
 
-from collections import OrderedDict
+import hashlib
+import json
+import logging
+import threading
+import weakref
+from collections import Counter, namedtuple
+from concurrent import futures
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
+from time import mktime, monotonic
+
+from sqlalchemy import (
+    and_,
+    case,
+    create_engine,
+    event,
+    func,
+    insert,
+    inspect,
+    not_,
+    or_,
+    select,
+    update,
+)
+from sqlalchemy.orm import joinedload, object_session, selectinload
 
-from sqlalchemy import and_, func, not_, select, text
-from tahrir_messages import BadgeAwardV1, PersonLoginFirstV1, PersonRankAdvanceV1
-
+from . import queries
+from .cache import detached_copy, dump_objects, load_objects
 from .model import (
     Assertion,
     Authorization,
     Badge,
+    BadgeTag,
     CurrentValue,
+    get_assertion_recipient,
     Invitation,
     Issuer,
     Milestone,
     Person,
+    salt_default,
     Series,
     Team,
+    update_assertion_counts,
+)
+from .outbox import dump_message
+from .utils import (
+    autocommit,
+    convert_name_to_id,
+    get_db_manager_from_uri,
+    get_session_factory,
+    set_statement_timeout,
 )
-from .utils import autocommit, convert_name_to_id, get_db_manager_from_uri
+
+
+log = logging.getLogger(__name__)
+
+# The number of assertions loaded per query by serialize_assertions()
+SERIALIZE_CHUNK_SIZE = 500
+
+LeaderboardEntry = namedtuple("LeaderboardEntry", ["person_id", "nickname", "badges", "rank"])
+
+
+def _refresh_loaded_objects(orm_execute_state):
+    # The replica's session is kept between calls, refresh the objects it
+    # already loaded with the rows it reads.
+    if orm_execute_state.is_select:
+        orm_execute_state.update_execution_options(populate_existing=True)
+
+
+def _merge_cached(session, obj):
+    """Return the object of the session with the identity of a cached copy.
+
+    An object of the session with pending changes is returned as is: merging
+    the copy into it would overwrite them.
+    """
+    existing = session.identity_map.get(inspect(obj).key)
+    if existing is not None and inspect(existing).modified:
+        return existing
+    return session.merge(obj, load=False)
+
+
+class _TransactionState:
+    """What a TahrirDatabase tracks about the current transaction of a session."""
+
+    def __init__(self):
+        self.batch_depth = 0
+        self.notifications = []
+        self.stale_versions = set()
+        self.ranks_changed = False
+        # The badges awarded to each person id since adjust_ranks() was last
+        # called for them, and the same as of the last commit.
+        self.unranked_awards = Counter()
+        self.committed_unranked_awards = {}
+        self.primary_reads = 0
+        self.writes_pending = False
+        self.last_write = None
+        self.reset_calls()
+
+    def reset_calls(self):
+        self.uncommitted_calls = 0
+        self.uncommitted_since = None
 
 
 class TahrirDatabase:
@@ -28,31 +110,495 @@ class TahrirDatabase:
     Class for talking to the Tahrir database
     It handles adding information necessary to issue open badges
 
-    Pass one or the other of the two parameters, but not both.
+    Pass one of the ``dburi``, ``session`` or ``engine`` parameters.
 
     :type dburi: str
     :param dburi: the sqlalchemy database URI
 
     :type session: SQLAlchemy session object
     :param session: an already configured session object.
-    """
 
-    def __init__(self, dburi=None, session=None, autocommit=True, notification_callback=None):
-        if not dburi and not session:
-            raise ValueError("You must provide either 'dburi' or 'session'")
+    :type engine: sqlalchemy.engine.Engine
+    :param engine: an existing engine, to share its connection pool between
+        instances.
+
+    :type engine_options: dict
+    :param engine_options: options passed to ``create_engine()`` with
+        ``dburi``, such as ``pool_size``, ``max_overflow``,
+        ``pool_pre_ping`` or the dialect's ``executemany_mode``.
+
+    :type statement_timeout: float
+    :param statement_timeout: with ``dburi``, abort the statements running
+        for longer than this many seconds.
+
+    :type scoped: bool
+    :param scoped: with ``dburi`` or ``engine``, use a scoped session: each
+        thread gets its own session from the shared engine, so a single
+        instance can serve many worker threads. Call :meth:`remove_session`
+        at the end of each request.
+
+    :type read_dburi: str
+    :param read_dburi: the URI of a read-only replica of the database. The
+        leaderboards, the lists of badges, persons and assertions, and the
+        assertions of a person are then read from it, except right after
+        this API wrote to the database, see ``read_your_writes``, and in
+        :meth:`use_primary` blocks. Don't modify the objects they return.
+
+    :type read_your_writes: float
+    :param read_your_writes: the number of seconds after a commit with
+        changes during which the reads stay on the primary database, so that
+        they see these changes despite the replication lag. Reads also stay
+        on the primary while the current transaction has changes.
+
+    :type cache: tahrir_api.cache.LRUCache
+    :param cache: an optional cache for the badges, issuers, teams and series
+        lookups. It can be shared between instances, and is invalidated when
+        these objects are added or deleted through this API.
+
+    :type shared_cache: tahrir_api.cache.CacheBackend
+    :param shared_cache: an optional cache shared between processes for the
+        leaderboard and the assertions of a person. Its keys are versioned,
+        and the versions are bumped when a commit awards badges, deletes
+        persons or changes their nickname or opt-out setting.
+
+    :type shared_cache_ttl: int
+    :param shared_cache_ttl: the number of seconds the results are kept in
+        the shared cache.
+
+    :type commit_every: int
+    :param commit_every: group commits: when set, autocommit only commits
+        after this many mutating calls.
+
+    :type commit_interval: float
+    :param commit_interval: group commits: when set, autocommit only commits
+        on the first mutating call made this many seconds after the oldest
+        uncommitted one. Call :meth:`commit` to commit what is left, e.g.
+        when idle or shutting down.
+
+    :type notification_workers: int
+    :param notification_workers: notifications are sent after the commit of
+        the transaction which queued them, and discarded if it's rolled back.
+        The exceptions raised by the ``notification_callback`` are logged.
+        When set, they are sent by a pool of this many background threads
+        instead of the committing one. Messages are then only sent in order
+        with a single worker.
+
+    :type notification_batch_size: int
+    :param notification_batch_size: the maximum number of notifications a
+        background thread sends at once.
+
+    :type outbox: bool
+    :param outbox: save the notifications in the outbox table, in the same
+        transaction as the changes they are about, instead of sending them
+        to the ``notification_callback``. The ``tahrir-drain-outbox`` script
+        publishes them.
+    """
 
-        if dburi and session:
-            raise ValueError("Provide only one, either 'dburi' or 'session'")
+    def __init__(
+        self,
+        dburi=None,
+        session=None,
+        autocommit=True,
+        notification_callback=None,
+        cache=None,
+        shared_cache=None,
+        shared_cache_ttl=300,
+        commit_every=None,
+        commit_interval=None,
+        notification_workers=None,
+        notification_batch_size=100,
+        outbox=False,
+        engine=None,
+        engine_options=None,
+        statement_timeout=None,
+        scoped=False,
+        read_dburi=None,
+        read_your_writes=5.0,
+    ):
+        sources = [source for source in (dburi, session, engine) if source]
+        if not sources:
+            raise ValueError("You must provide either 'dburi', 'session' or 'engine'")
+
+        if len(sources) > 1:
+            raise ValueError("Provide only one of 'dburi', 'session' or 'engine'")
+
+        if (engine_options or statement_timeout) and not dburi:
+            raise ValueError("The engine options can only be used with 'dburi'")
 
         self.autocommit = autocommit
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
 
         if dburi:
-            db_mgr = get_db_manager_from_uri(dburi)
-            self.session = db_mgr.Session()
-        else:
+            db_mgr = get_db_manager_from_uri(dburi, engine_args=engine_options)
+            if statement_timeout:
+                set_statement_timeout(db_mgr.engine, statement_timeout)
+            session_factory = db_mgr.Session
+        elif engine:
+            session_factory = get_session_factory(engine)
+        if session:
             self.session = session
+        elif scoped:
+            self.session = session_factory
+        else:
+            self.session = session_factory()
+        self.scoped = bool(scoped and not session)
+
+        self.read_session = None
+        self.read_your_writes = read_your_writes
+        if read_dburi:
+            read_factory = get_session_factory(
+                create_engine(read_dburi, **(engine_options or {})), expire_on_commit=False
+            )
+            self.read_session = read_factory if self.scoped else read_factory()
+            event.listen(self.read_session, "do_orm_execute", _refresh_loaded_objects)
 
         self.notification_callback = notification_callback
+        self.notification_batch_size = notification_batch_size
+        self.outbox = outbox
+        self._executor = None
+        self._dispatched = []
+        self._dispatched_lock = threading.Lock()
+        if notification_workers:
+            self._executor = futures.ThreadPoolExecutor(
+                notification_workers, thread_name_prefix="tahrir-notifications"
+            )
+
+        self.cache = cache
+        self.shared_cache = shared_cache
+        self.shared_cache_ttl = shared_cache_ttl
+        self._listeners = []
+        if shared_cache is not None:
+            self._listen("after_flush", "_collect_stale_versions")
+        self._listen("after_flush", "_invalidate_changed")
+        self._listen("after_flush", "_collect_rank_changes")
+        self._listen("before_commit", "_fix_ranks")
+        self._listen("after_commit", "_after_commit")
+        self._listen("after_rollback", "_after_rollback")
+        if self.read_session is not None:
+            self._listen("after_flush", "_note_flush")
+            self._listen("do_orm_execute", "_note_execute")
+
+    def _listen(self, identifier, method_name):
+        """Call a method on an event of the session, until this instance is closed or collected.
+
+        The listener doesn't keep the instance alive: sessions given to the
+        constructor, and the session classes of scoped sessions, can outlive
+        many instances.
+        """
+        ref = weakref.ref(self)
+
+        def listener(*args):
+            api = ref()
+            if api is not None:
+                getattr(api, method_name)(*args)
+
+        event.listen(self.session, identifier, listener)
+        self._listeners.append(
+            weakref.finalize(self, event.remove, self.session, identifier, listener)
+        )
+
+    def _cached(self, entity, key, load):
+        """Return the object cached for this key, or load it and cache it."""
+        if self.cache is None:
+            return load()
+        cache_key = (entity.__name__, str(key).lower())
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            return _merge_cached(self.session, cached)
+        obj = load()
+        if obj is not None:
+            self.cache.set(cache_key, detached_copy(obj))
+        return obj
+
+    def _invalidate(self, entity, key):
+        if self.cache is not None:
+            self.cache.invalidate((entity.__name__, str(key).lower()))
+
+    def _invalidate_changed(self, session, flush_context):
+        # The objects can also be changed without this API, e.g. by an admin.
+        if self.cache is None:
+            return
+        for obj in session.dirty | session.deleted:
+            if isinstance(obj, (Badge, Issuer, Series, Team)):
+                self._invalidate(type(obj), obj.id)
+
+    def _transaction(self, session=None):
+        """Return what this API tracks about the current transaction of the session.
+
+        It's kept in the session's info, so that each thread has its own with
+        scoped sessions.
+        """
+        info = (self.session if session is None else session).info
+        return info.setdefault(("tahrir_api", id(self)), _TransactionState())
+
+    @contextmanager
+    def batch(self):
+        """Group the API calls made in this block in a single transaction.
+
+        The calls return as usual, but are only committed when the outermost
+        block exits, and their notifications are sent after that commit
+        succeeds. If the block raises, the transaction is rolled back and the
+        notifications are discarded. Blocks can be nested.
+        """
+        transaction = self._transaction()
+        transaction.batch_depth += 1
+        try:
+            yield self
+        except BaseException:
+            transaction.batch_depth -= 1
+            if not transaction.batch_depth:
+                self.rollback()
+            raise
+        transaction.batch_depth -= 1
+        if not transaction.batch_depth:
+            self.commit()
+
+    def _autocommit(self):
+        """Commit after a mutating call, unless it's batched or a group commit is due later."""
+        transaction = self._transaction()
+        if transaction.batch_depth:
+            return
+        transaction.uncommitted_calls += 1
+        if transaction.uncommitted_since is None:
+            transaction.uncommitted_since = monotonic()
+        if self.commit_every or self.commit_interval:
+            due = (self.commit_every and transaction.uncommitted_calls >= self.commit_every) or (
+                self.commit_interval
+                and monotonic() - transaction.uncommitted_since >= self.commit_interval
+            )
+            if not due:
+                return
+        self.commit()
+
+    def commit(self):
+        """Commit the session, which sends the notifications queued until then."""
+        self._transaction().reset_calls()
+        try:
+            self.session.commit()
+        except Exception:
+            self.rollback()
+            raise
+
+    def rollback(self):
+        """Roll the session back, which discards the notifications queued until then."""
+        self._transaction().reset_calls()
+        self.session.rollback()
+
+    @property
+    def _notifying(self):
+        return self.outbox or self.notification_callback is not None
+
+    def _notify(self, message):
+        """Queue a notification, it will be sent after the transaction is committed."""
+        if self.outbox:
+            self.session.add(dump_message(message))
+        elif self.notification_callback:
+            self._transaction().notifications.append(message)
+
+    def _after_commit(self, session):
+        transaction = self._transaction(session)
+        if transaction.writes_pending:
+            transaction.writes_pending = False
+            transaction.last_write = monotonic()
+        transaction.committed_unranked_awards = dict(transaction.unranked_awards)
+        if self.shared_cache is not None:
+            self._bump_stale_versions(transaction.stale_versions)
+        messages, transaction.notifications = transaction.notifications, []
+        if not messages:
+            return
+        if self._executor is None:
+            self._send_notifications(messages)
+            return
+        with self._dispatched_lock:
+            self._dispatched = [future for future in self._dispatched if not future.done()]
+            for index in range(0, len(messages), self.notification_batch_size):
+                batch = messages[index : index + self.notification_batch_size]
+                self._dispatched.append(self._executor.submit(self._send_notifications, batch))
+
+    def _after_rollback(self, session):
+        transaction = self._transaction(session)
+        transaction.writes_pending = False
+        transaction.ranks_changed = False
+        transaction.unranked_awards = Counter(transaction.committed_unranked_awards)
+        transaction.stale_versions.clear()
+        transaction.notifications = []
+
+    def _send_notifications(self, messages):
+        # This runs after the commit, raising would leave the session unusable
+        # and drop the other messages: the failures are only logged.
+        for message in messages:
+            try:
+                self.notification_callback(message)
+            except Exception:
+                log.exception("Could not send the notification %r", message)
+
+    def wait_for_notifications(self, timeout=None):
+        """Wait until the background threads have sent the notifications of past commits.
+
+        :type timeout: float
+        :param timeout: The maximum number of seconds to wait.
+
+        :rtype: bool
+        :returns: True if all notifications were sent.
+        """
+        with self._dispatched_lock:
+            dispatched = list(self._dispatched)
+        done, not_done = futures.wait(dispatched, timeout=timeout)
+        return not not_done
+
+    def _note_flush(self, session, flush_context):
+        self._transaction(session).writes_pending = True
+
+    def _note_execute(self, orm_execute_state):
+        if not orm_execute_state.is_select:
+            self._transaction(orm_execute_state.session).writes_pending = True
+
+    def _reads_from_primary(self):
+        transaction = self._transaction()
+        return (
+            transaction.primary_reads > 0
+            or transaction.writes_pending
+            or (
+                transaction.last_write is not None
+                and monotonic() - transaction.last_write < self.read_your_writes
+            )
+        )
+
+    @contextmanager
+    def _reading(self):
+        """Yield the session to run the queries of a read-only method with."""
+        if self.read_session is None or self._reads_from_primary():
+            yield self.session
+            return
+        try:
+            yield self.read_session
+        finally:
+            # Don't keep a snapshot of the replica between calls.
+            self.read_session.commit()
+
+    @contextmanager
+    def use_primary(self):
+        """Read from the primary database in this block, even with a read replica."""
+        transaction = self._transaction()
+        transaction.primary_reads += 1
+        try:
+            yield self
+        finally:
+            transaction.primary_reads -= 1
+
+    def remove_session(self):
+        """End the current thread's session, the next call will use a new one.
+
+        This returns its connection to the pool. It's only available with
+        scoped sessions, call it at the end of each request.
+        """
+        if not self.scoped:
+            raise ValueError("Sessions can only be removed in the scoped mode")
+        self.session.remove()
+        if self.read_session is not None:
+            self.read_session.remove()
+
+    def close(self):
+        """Wait for the pending notifications, stop the background threads and close the session."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._dispatched = []
+        for remove_listener in self._listeners:
+            remove_listener()
+        for session in (self.session, self.read_session):
+            if session is None:
+                continue
+            if self.scoped:
+                session.remove()
+            else:
+                session.close()
+
+    def _collect_stale_versions(self, session, flush_context):
+        stale_versions = self._transaction(session).stale_versions
+        # The session still lists what was flushed in new, dirty and deleted.
+        for obj in session.new | session.deleted:
+            if isinstance(obj, Assertion):
+                stale_versions.update(["leaderboard", f"person:{obj.person_id}"])
+            elif isinstance(obj, Person) and obj in session.deleted:
+                stale_versions.update(["leaderboard", f"person:{obj.id}"])
+        for obj in session.dirty:
+            if isinstance(obj, Person):
+                state = inspect(obj)
+                if any(state.attrs[key].history.has_changes() for key in ("opt_out", "nickname")):
+                    stale_versions.add("leaderboard")
+
+    def _collect_rank_changes(self, session, flush_context):
+        # adjust_ranks() only handles awards, the other changes of the
+        # leaderboard are fixed by rebuilding the ranks before the commit.
+        transaction = self._transaction(session)
+        for obj in session.new:
+            if isinstance(obj, Assertion):
+                transaction.unranked_awards[obj.person_id] += 1
+        for obj in session.deleted:
+            if isinstance(obj, Assertion) or (isinstance(obj, Person) and obj.rank is not None):
+                transaction.ranks_changed = True
+        for obj in session.dirty:
+            if isinstance(obj, Person) and inspect(obj).attrs.opt_out.history.has_changes():
+                transaction.ranks_changed = True
+
+    def _fix_ranks(self, session):
+        # The commit only flushes after this event, flush to see all the changes.
+        session.flush()
+        transaction = self._transaction(session)
+        if transaction.ranks_changed:
+            transaction.ranks_changed = False
+            self.rebuild_ranks()
+
+    def _bump_stale_versions(self, stale_versions):
+        # Bump after the commit, so that the new versions are never populated
+        # with data read before it.
+        for name in stale_versions:
+            self.shared_cache.incr(f"tahrir:version:{name}")
+        stale_versions.clear()
+
+    def _shared_cached(self, name, versions, args, load, dump=list, restore=list):
+        """Return the result cached under these versions and arguments, or load and cache it."""
+        if self.shared_cache is None:
+            return load()
+        version = ".".join(self.shared_cache.get(f"tahrir:version:{v}") or "0" for v in versions)
+        digest = hashlib.sha1(repr(args).encode("utf-8")).hexdigest()
+        key = f"tahrir:{name}:{version}:{digest}"
+        cached = self.shared_cache.get(key)
+        if cached is not None:
+            return restore(json.loads(cached))
+        result = load()
+        self.shared_cache.set(key, json.dumps(dump(result)), ttl=self.shared_cache_ttl)
+        return result
+
+    def _exists(self, query):
+        """Return True if the given query matches at least one row, using EXISTS."""
+        return self.session.scalar(queries.exists(query))
+
+    def _iter_all(self, entity, criteria=(), page_size=1000, rows=False):
+        """Yield the objects (or rows) of a table, a page at a time, in primary key order.
+
+        The pages start after the last primary key seen instead of using an
+        OFFSET, so each one is an index range scan however far the iteration is.
+        """
+        if page_size < 1:
+            raise ValueError("The page size must be positive")
+        (key,) = inspect(entity).primary_key
+        columns = entity.__table__.columns if rows else (entity,)
+        last = None
+        while True:
+            query = select(*columns).where(*criteria).order_by(key).limit(page_size)
+            if last is not None:
+                query = query.where(key > last)
+            count = 0
+            with self._reading() as session:
+                result = session.execute(query.execution_options(yield_per=page_size))
+                for item in result if rows else result.scalars():
+                    yield item
+                    count += 1
+                    last = item.id
+            if count < page_size:
+                return
 
     def team_exists(self, team_id):
         """
@@ -62,9 +608,7 @@ class TahrirDatabase:
         :param team_id: The ID of a Team
         """
 
-        return (
-            self.session.query(Team).filter(func.lower(Team.id) == func.lower(team_id)).count() != 0
-        )
+        return self._exists(queries.team(team_id))
 
     def get_team(self, team_id):
         """
@@ -74,11 +618,9 @@ class TahrirDatabase:
         :param team_id: The ID of the team to return
         """
 
-        if self.team_exists(team_id):
-            return (
-                self.session.query(Team).filter(func.lower(Team.id) == func.lower(team_id)).first()
-            )
-        return None
+        return self._cached(
+            Team, team_id, lambda: self.session.scalars(queries.team(team_id)).first()
+        )
 
     @autocommit
     def create_team(self, name, team_id=None):
@@ -99,6 +641,7 @@ class TahrirDatabase:
 
             self.session.add(new_team)
             self.session.flush()
+            self._invalidate(Team, team_id)
         return team_id
 
     def series_exists(self, series_id):
@@ -109,12 +652,7 @@ class TahrirDatabase:
         :param series_id: The ID of a Series
         """
 
-        return (
-            self.session.query(Series)
-            .filter(func.lower(Series.id) == func.lower(series_id))
-            .count()
-            != 0
-        )
+        return self._exists(queries.series(series_id))
 
     def get_series(self, series_id):
         """
@@ -124,13 +662,11 @@ class TahrirDatabase:
         :param series_id: The ID of the series to return
         """
 
-        if self.series_exists(series_id):
-            return (
-                self.session.query(Series)
-                .filter(func.lower(Series.id) == func.lower(series_id))
-                .one()
-            )
-        return None
+        return self._cached(
+            Series,
+            series_id,
+            lambda: self.session.scalars(queries.series(series_id)).one_or_none(),
+        )
 
     def get_series_from_team(self, team_id):
         """
@@ -173,6 +709,7 @@ class TahrirDatabase:
 
             self.session.add(new_series)
             self.session.flush()
+            self._invalidate(Series, series_id)
         return series_id
 
     def get_all_series(self):
@@ -189,7 +726,7 @@ class TahrirDatabase:
         :type milestone_id: str
         :param milestone_id: The ID of a Milestone
         """
-        return self.session.query(Milestone).filter(Milestone.id == milestone_id).count() != 0
+        return self._exists(self.session.query(Milestone).filter(Milestone.id == milestone_id))
 
     def milestone_exists_for_badge_series(self, badge_id, series_id):
         """
@@ -201,7 +738,7 @@ class TahrirDatabase:
         :type series_id: str
         :param series_id: The ID of the series
         """
-        return self.get_milestone_from_badge_series(badge_id, series_id).count() != 0
+        return self._exists(self.get_milestone_from_badge_series(badge_id, series_id))
 
     def get_milestone_from_badge_series(self, badge_id, series_id):
         """
@@ -229,14 +766,39 @@ class TahrirDatabase:
         """
         return self.session.query(Milestone).filter(Milestone.id == milestone_id)
 
-    def get_all_milestones(self, series_id):
+    def get_all_milestones(self, series_id, load=None):
         """
         Returns all the milestones for the series
 
         :type series_id: str
         :param series_id: The id of the Series
+
+        :type load: str
+        :param load: Set to "full" to also load what the milestones'
+            ``as_dict()`` needs (badges, issuers and series).
+        """
+        return (
+            self.session.query(Milestone)
+            .filter(Milestone.series_id == series_id)
+            .options(*self._load_options(Milestone, load))
+            .all()
+        )
+
+    def _load_options(self, entity, load):
+        """Return the loader options for the given load mode.
+
+        The "full" mode eagerly loads the relationships followed by the
+        entity's ``as_dict()`` method, instead of lazily loading them one
+        object at a time.
         """
-        return self.session.query(Milestone).filter(Milestone.series_id == series_id).all()
+        if load is None:
+            return []
+        if load != "full":
+            raise ValueError(f"Unknown load mode {load!r}")
+        options = [selectinload(entity.badge).joinedload(Badge.issuer)]
+        if entity is Milestone:
+            options.append(joinedload(Milestone.series))
+        return options
 
     @autocommit
     def create_milestone(self, position, badge_id, series_id):
@@ -282,23 +844,33 @@ class TahrirDatabase:
 
         return unique_milestones
 
-    def get_badges_from_team(self, team_id):
+    def get_badges_from_team(self, team_id, ordered=False):
         """
         Returns all the badges related to a team
 
         :type team_id: str
         :param team_id: id of the team
-        """
-        if self.team_exists(team_id):
-            series = self.get_series_from_team(team_id)
-            series_ids = [elem.id for elem in series]
 
-            milestones = self.get_milestone_from_series_ids(series_ids)
-            badge_ids = list(set([milestone.badge_id for milestone in milestones]))
+        :type ordered: bool
+        :param ordered: Order the badges by series and by milestone position
+        """
+        # Outer joins from the team, to tell a team without badges from a
+        # missing team in the same query.
+        query = (
+            self.session.query(Team.id, Badge)
+            .outerjoin(Series, Series.team_id == Team.id)
+            .outerjoin(Milestone, Milestone.series_id == Series.id)
+            .outerjoin(Badge, Badge.id == Milestone.badge_id)
+            .filter(func.lower(Team.id) == func.lower(team_id))
+            .group_by(Team.id, Badge.id)
+        )
+        if ordered:
+            query = query.order_by(func.min(Series.id), func.min(Milestone.position), Badge.id)
 
-            badges = self.get_badges(badge_ids)
-            return badges
-        return None
+        rows = query.all()
+        if not rows:
+            return None
+        return [badge for _team_id, badge in rows if badge is not None]
 
     def badge_exists(self, badge_id):
         """
@@ -308,10 +880,9 @@ class TahrirDatabase:
         :param badge_id: The ID of a Badge
         """
 
-        return (
-            self.session.query(Badge).filter(func.lower(Badge.id) == func.lower(badge_id)).count()
-            != 0
-        )
+        if self.cache is not None:
+            return self.get_badge(badge_id) is not None
+        return self._exists(queries.badge(badge_id))
 
     def get_badge(self, badge_id):
         """
@@ -321,11 +892,11 @@ class TahrirDatabase:
         :param badge_id: The ID of the badge to return
         """
 
-        if self.badge_exists(badge_id):
-            return (
-                self.session.query(Badge).filter(func.lower(Badge.id) == func.lower(badge_id)).one()
-            )
-        return None
+        return self._cached(
+            Badge,
+            badge_id,
+            lambda: self.session.scalars(queries.badge(badge_id)).one_or_none(),
+        )
 
     def get_badges(self, badge_ids):
         """
@@ -349,39 +920,45 @@ class TahrirDatabase:
         :param match_all: Returned badges must have all tags in list
         """
 
-        badges = list()
+        tags = {tag.strip().lower() for tag in tags}
+        if not tags:
+            return self.get_all_badges().all() if match_all else []
 
-        if match_all:
-            # Return badges matching all tags
-            # ... by doing argument-expansion on a list comprehension
-            badges.extend(
-                self.session.query(Badge).filter(
-                    and_(*[func.lower(Badge.tags).contains(str(tag + ",").lower()) for tag in tags])
-                )
+        with self._reading() as session:
+            query = (
+                session.query(Badge)
+                .join(BadgeTag)
+                .filter(BadgeTag.tag.in_(tags))
+                .group_by(Badge.id)
+                .order_by(Badge.id)
             )
-        else:
-            # Return badges matching any of the tags
-            for tag in tags:
-                badges.extend(
-                    self.session.query(Badge)
-                    .filter(func.lower(Badge.tags).contains(str(tag + ",").lower()))
-                    .all()
-                )
+            if match_all:
+                # Return badges matching all tags
+                query = query.having(func.count(BadgeTag.tag) == len(tags))
 
-        # Eliminate any duplicates.
-        unique_badges = list()
-        for badge in badges:
-            if badge not in unique_badges:
-                unique_badges.append(badge)
-
-        return unique_badges
+            return query.all()
 
     def get_all_badges(self):
         """
         Get all badges in the db.
         """
 
-        return self.session.query(Badge)
+        with self._reading() as session:
+            return session.query(Badge)
+
+    def iter_all_badges(self, page_size=1000, rows=False):
+        """
+        Iterate over all badges in the db, without loading them all at once.
+
+        :type page_size: int
+        :param page_size: the number of badges read from the db at a time
+
+        :type rows: bool
+        :param rows: yield rows of the ``badges`` columns instead of Badge
+            objects, which is cheaper when they are only read.
+        """
+
+        return self._iter_all(Badge, page_size=page_size, rows=rows)
 
     @autocommit
     def delete_badge(self, badge_id):
@@ -392,10 +969,11 @@ class TahrirDatabase:
         :param badge_id: ID of the badge to delete
         """
 
-        if self.badge_exists(badge_id):
-            to_delete = self.session.query(Badge).filter_by(id=badge_id).one()
+        to_delete = self.get_badge(badge_id)
+        if to_delete is not None:
             self.session.delete(to_delete)
             self.session.flush()
+            self._invalidate(Badge, badge_id)
             return badge_id
         return False
 
@@ -443,6 +1021,7 @@ class TahrirDatabase:
             )
             self.session.add(new_badge)
             self.session.flush()
+            self._invalidate(Badge, badge_id)
         return badge_id
 
     def person_exists(self, email=None, id=None, nickname=None):
@@ -461,11 +1040,11 @@ class TahrirDatabase:
 
         query = self.session.query(Person)
         if email:
-            return query.filter(func.lower(Person.email) == func.lower(email)).count() != 0
+            return self._exists(query.filter(func.lower(Person.email) == func.lower(email)))
         elif id:
-            return query.filter_by(id=id).count() != 0
+            return self._exists(query.filter_by(id=id))
         elif nickname:
-            return query.filter(func.lower(Person.nickname) == func.lower(nickname)).count() != 0
+            return self._exists(query.filter(func.lower(Person.nickname) == func.lower(nickname)))
         else:
             return False
 
@@ -486,10 +1065,29 @@ class TahrirDatabase:
         Gets all the persons in the db.
         """
 
-        query = self.session.query(Person)
-        if not include_opted_out:
-            query = query.filter(not_(Person.opt_out))
-        return query
+        with self._reading() as session:
+            query = session.query(Person)
+            if not include_opted_out:
+                query = query.filter(not_(Person.opt_out))
+            return query
+
+    def iter_all_persons(self, include_opted_out=False, page_size=1000, rows=False):
+        """
+        Iterate over all the persons in the db, without loading them all at once.
+
+        :type include_opted_out: bool
+        :param include_opted_out: also yield the persons who opted out
+
+        :type page_size: int
+        :param page_size: the number of persons read from the db at a time
+
+        :type rows: bool
+        :param rows: yield rows of the ``persons`` columns instead of Person
+            objects, which is cheaper when they are only read.
+        """
+
+        criteria = () if include_opted_out else (not_(Person.opt_out),)
+        return self._iter_all(Person, criteria, page_size=page_size, rows=rows)
 
     def get_person_email(self, person_id):
         """
@@ -509,14 +1107,7 @@ class TahrirDatabase:
         :param person_id: The email of a Person in the database.
         """
 
-        if self.person_exists(id=person_id):
-            return (
-                self.session.query(Person)
-                .filter(func.lower(Person.id) == func.lower(person_id))
-                .one()
-                .email
-            )
-        return None
+        return self.session.scalar(select(Person.email).where(Person.id == person_id))
 
     def get_person(self, person_email=None, id=None, nickname=None):
         """
@@ -533,16 +1124,15 @@ class TahrirDatabase:
         :param nickname: The nickname of a Person in the database
         """
 
-        query = self.session.query(Person)
+        return self._find_person(self.session, person_email, id, nickname)
 
-        if person_email and self.person_exists(email=person_email):
-            return query.filter(func.lower(Person.email) == func.lower(person_email)).one()
-        elif id and self.person_exists(id=id):
-            return query.filter_by(id=id).one()
-        elif nickname and self.person_exists(nickname=nickname):
-            return query.filter(func.lower(Person.nickname) == func.lower(nickname)).one()
-        else:
-            return None
+    def _find_person(self, session, person_email=None, id=None, nickname=None):
+        # Each criterion is only tried if the previous ones didn't match.
+        for query in queries.person_lookups(person_email, id, nickname):
+            person = session.scalars(query).one_or_none()
+            if person is not None:
+                return person
+        return None
 
     @autocommit
     def delete_person(self, person_email):
@@ -553,8 +1143,9 @@ class TahrirDatabase:
         :param person_email: Email of the person to delete
         """
 
-        if self.person_exists(email=person_email):
-            self.session.delete(self.get_person(person_email))
+        person = self.get_person(person_email)
+        if person is not None:
+            self.session.delete(person)
             self.session.flush()
             return person_email
         return False
@@ -603,9 +1194,11 @@ class TahrirDatabase:
 
         # If this is the first time they have ever logged in, optionally
         # publish a notification about the event.
-        if not person.last_login and self.notification_callback:
+        if not person.last_login and self._notifying:
+            from tahrir_messages import PersonLoginFirstV1
+
             body = dict(user=dict(username=person.nickname, badges_user_id=person.id))
-            self.notification_callback(PersonLoginFirstV1(body=body))
+            self._notify(PersonLoginFirstV1(body=body))
 
         # Finally, update the field.
         person.last_login = datetime.now(timezone.utc)
@@ -618,7 +1211,7 @@ class TahrirDatabase:
         :param issuer_id: The unique ID of this issuer
         """
 
-        return self.session.query(Issuer).filter_by(origin=origin, name=name).count() != 0
+        return self._exists(self.session.query(Issuer).filter_by(origin=origin, name=name))
 
     @autocommit
     def add_invitation(self, badge_id, created_on=None, expires_on=None, created_by_email=None):
@@ -644,9 +1237,10 @@ class TahrirDatabase:
 
         created_on = created_on or datetime.now(timezone.utc)
         expires_on = expires_on or (created_on + timedelta(hours=1))
-        if not created_by_email or not self.person_exists(email=created_by_email):
+        creator = self.get_person(created_by_email) if created_by_email else None
+        if creator is None:
             raise ValueError(f"No user with email {created_by_email!r}. Ask them to login first.")
-        created_by = self.get_person(created_by_email).id
+        created_by = creator.id
 
         invitation = Invitation(
             created_on=created_on,
@@ -666,7 +1260,7 @@ class TahrirDatabase:
         :param invitation_id: The unique ID of this invitation
         """
 
-        return self.session.query(Invitation).filter_by(id=invitation_id).count() != 0
+        return self._exists(self.session.query(Invitation).filter_by(id=invitation_id))
 
     def get_all_invitations(self):
         """
@@ -675,6 +1269,20 @@ class TahrirDatabase:
 
         return self.session.query(Invitation)
 
+    def iter_all_invitations(self, page_size=1000, rows=False):
+        """
+        Iterate over all invitations in the db, without loading them all at once.
+
+        :type page_size: int
+        :param page_size: the number of invitations read from the db at a time
+
+        :type rows: bool
+        :param rows: yield rows of the ``invitations`` columns instead of Invitation
+            objects, which is cheaper when they are only read.
+        """
+
+        return self._iter_all(Invitation, page_size=page_size, rows=rows)
+
     def get_invitation(self, invitation_id):
         """
         Get invitation by an invitation id.
@@ -683,10 +1291,10 @@ class TahrirDatabase:
         :param invitation_id: The unique ID of this invitation
         """
 
-        if self.invitation_exists(invitation_id):
-            return self.session.query(Invitation).filter_by(id=invitation_id).one()
-        else:
+        invitation = self.session.query(Invitation).filter_by(id=invitation_id).one_or_none()
+        if invitation is None:
             return False
+        return invitation
 
     def get_invitations(self, person_id):
         """
@@ -706,10 +1314,11 @@ class TahrirDatabase:
         :type issuer_id: int
         :param issuer_id: ID of the issuer to return
         """
-        query = self.session.query(Issuer).filter_by(id=issuer_id)
-        if query.count() > 0:
-            return query.one()
-        return None
+        return self._cached(
+            Issuer,
+            issuer_id,
+            lambda: self.session.scalars(queries.issuer(issuer_id)).one_or_none(),
+        )
 
     @autocommit
     def delete_issuer(self, issuer_id):
@@ -720,11 +1329,11 @@ class TahrirDatabase:
         :param issuer_id: ID of the issuer to be delete
         """
 
-        query = self.session.query(Issuer).filter_by(id=issuer_id)
-        if query.count() > 0:
-            to_delete = query.one()
+        to_delete = self.get_issuer(issuer_id)
+        if to_delete is not None:
             self.session.delete(to_delete)
             self.session.flush()
+            self._invalidate(Issuer, issuer_id)
             return issuer_id
         return False
 
@@ -750,6 +1359,7 @@ class TahrirDatabase:
             new_issuer = Issuer(origin=origin, name=name, org=org, contact=contact)
             self.session.add(new_issuer)
             self.session.flush()
+            self._invalidate(Issuer, new_issuer.id)
             return new_issuer.id
 
         return self.session.query(Issuer).filter_by(name=name, origin=origin).one().id
@@ -766,20 +1376,147 @@ class TahrirDatabase:
         Get all assertions in the db.
         """
 
-        return self.session.query(Assertion)
+        with self._reading() as session:
+            return session.query(Assertion)
+
+    def iter_all_assertions(self, page_size=1000, rows=False):
+        """
+        Iterate over all assertions in the db, without loading them all at once.
+
+        :type page_size: int
+        :param page_size: the number of assertions read from the db at a time
+
+        :type rows: bool
+        :param rows: yield rows of the ``assertions`` columns instead of Assertion
+            objects, which is cheaper when they are only read.
+        """
+
+        return self._iter_all(Assertion, page_size=page_size, rows=rows)
 
-    def get_assertions_by_email(self, person_email):
+    def get_assertions_by_email(self, person_email, load=None):
         """
         Get all assertions attached to the given email
 
         :type person_email: str
         :param person_email: Email of the person to get assertions for
+
+        :type load: str
+        :param load: Set to "full" to also load what the assertions'
+            ``as_dict()`` needs (badges and issuers).
         """
 
-        person = self.get_person(person_email=person_email)
-        if person is None:
-            return False
-        return self.session.query(Assertion).filter_by(person_id=person.id).all()
+        with self._reading() as session:
+            person = self._find_person(session, person_email)
+            if person is None:
+                return False
+            query = queries.assertions_of_person(person.id).options(
+                *self._load_options(Assertion, load)
+            )
+            if load is not None:
+                return session.scalars(query).all()
+            return self._shared_cached(
+                "assertions",
+                [f"person:{person.id}"],
+                (person.id,),
+                lambda: session.scalars(query).all(),
+                dump=dump_objects,
+                restore=lambda rows: [
+                    _merge_cached(session, obj) for obj in load_objects(Assertion, rows)
+                ],
+            )
+
+    def serialize_assertions(self, assertions):
+        """
+        Return the ``as_dict()`` of many assertions with a bounded number of queries
+
+        The assertions, their badges and the badges' issuers are loaded in
+        bulk instead of one at a time.
+
+        :type assertions: iterable
+        :param assertions: The Assertion objects to serialize
+        """
+
+        assertions = list(assertions)
+        ids = [state.identity[0] for state in map(inspect, assertions) if state.identity]
+        # With a read replica, the assertions may belong to its session.
+        session = (object_session(assertions[0]) if assertions else None) or self.session
+        for offset in range(0, len(ids), SERIALIZE_CHUNK_SIZE):
+            chunk = ids[offset : offset + SERIALIZE_CHUNK_SIZE]
+            # This loads the expired attributes and the relationships of the
+            # assertions already in the session.
+            session.query(Assertion).filter(Assertion.id.in_(chunk)).options(
+                *self._load_options(Assertion, "full")
+            ).all()
+        return [assertion.as_dict() for assertion in assertions]
+
+    def iter_assertion_dicts(self, badge_id=None, person_id=None, page_size=1000):
+        """
+        Yield the ``as_dict()`` of the assertions, without loading them as objects
+
+        The assertions are read with their badges and issuers in a single
+        query, and the dicts of each badge and issuer are only built once.
+
+        :type badge_id: str
+        :param badge_id: Only yield the assertions of the badge with this ID
+
+        :type person_id: int
+        :param person_id: Only yield the assertions of the person with this ID
+
+        :type page_size: int
+        :param page_size: the number of rows read from the db at a time
+        """
+
+        query = queries.assertion_export(badge_id, person_id)
+        issuers = {}
+        badges = {}
+        with self._reading() as session:
+            for row in session.execute(query.execution_options(yield_per=page_size)):
+                badge = badges.get(row.badge_id)
+                if badge is None:
+                    issuer = issuers.get(row.issuer_id)
+                    if issuer is None:
+                        issuer = issuers[row.issuer_id] = dict(
+                            origin=row.issuer_origin,
+                            name=row.issuer_name,
+                            org=row.issuer_org,
+                            contact=row.issuer_contact,
+                            created_on=mktime(row.issuer_created_on.timetuple()),
+                        )
+                    image = row.badge_image
+                    if not image.startswith("http"):
+                        image = "/pngs/" + image
+                    badge = badges[row.badge_id] = dict(
+                        version="0.5.0",
+                        name=row.badge_name,
+                        image=image,
+                        description=row.badge_description,
+                        criteria=row.badge_criteria,
+                        issuer=issuer,
+                        created_on=mktime(row.badge_created_on.timetuple()),
+                        tags=row.badge_tags,
+                    )
+                result = dict(recipient=f"sha256${row.recipient}", salt=row.salt, badge=badge)
+                if row.issued_on:
+                    result["issued_on"] = row.issued_on.strftime("%Y-%m-%d")
+                yield result
+
+    def export_assertions(self, fileobj, badge_id=None, person_id=None):
+        """
+        Write the assertions to a file as newline-delimited JSON, one ``as_dict()`` per line
+
+        See :meth:`iter_assertion_dicts` for the parameters. Returns the
+        number of assertions written.
+
+        :type fileobj: file
+        :param fileobj: a file object opened in text mode
+        """
+
+        count = 0
+        for assertion in self.iter_assertion_dicts(badge_id, person_id):
+            fileobj.write(json.dumps(assertion))
+            fileobj.write("\n")
+            count += 1
+        return count
 
     def get_assertions_by_badge(self, badge_id):
         """
@@ -790,11 +1527,12 @@ class TahrirDatabase:
         """
 
         if self.badge_exists(badge_id):
-            return (
-                self.session.query(Assertion)
-                .filter(func.lower(Assertion.badge_id) == func.lower(badge_id))
-                .all()
-            )
+            with self._reading() as session:
+                return (
+                    session.query(Assertion)
+                    .filter(func.lower(Assertion.badge_id) == func.lower(badge_id))
+                    .all()
+                )
         else:
             return False
 
@@ -814,9 +1552,8 @@ class TahrirDatabase:
         if not person:
             return False
 
-        return (
-            self.session.query(Assertion).filter_by(person_id=person.id, badge_id=badge_id).count()
-            != 0
+        return self._exists(
+            self.session.query(Assertion).filter_by(person_id=person.id, badge_id=badge_id)
         )
 
     def authorization_exists(self, badge_id, email):
@@ -835,11 +1572,8 @@ class TahrirDatabase:
         if not person:
             return False
 
-        return (
-            self.session.query(Authorization)
-            .filter_by(person_id=person.id, badge_id=badge_id)
-            .count()
-            != 0
+        return self._exists(
+            self.session.query(Authorization).filter_by(person_id=person.id, badge_id=badge_id)
         )
 
     @autocommit
@@ -854,9 +1588,8 @@ class TahrirDatabase:
         :param person_email: Email of the Person grant rights to
         """
 
-        if self.person_exists(email=person_email) and self.badge_exists(badge_id):
-            person = self.get_person(person_email)
-
+        person = self.get_person(person_email)
+        if person is not None and self.badge_exists(badge_id):
             new_authz = Authorization(badge_id=badge_id, person_id=person.id)
             self.session.add(new_authz)
             self.session.flush()
@@ -887,35 +1620,124 @@ class TahrirDatabase:
         if issued_on is None:
             issued_on = datetime.now(timezone.utc)
 
-        if self.person_exists(email=person_email) and self.badge_exists(badge_id):
-            badge = self.get_badge(badge_id)
-            person = self.get_person(person_email)
-
+        person = self.get_person(person_email)
+        badge = self.get_badge(badge_id) if person is not None else None
+        if badge is not None:
+            # We already have the person's email, don't let the recipient
+            # default query it again.
+            salt = salt_default(None)
             new_assertion = Assertion(
                 badge_id=badge_id,
                 person_id=person.id,
+                salt=salt,
+                recipient=get_assertion_recipient(person.email, salt),
                 issued_on=issued_on,
                 issued_for=issued_for,
             )
             self.session.add(new_assertion)
             self.session.flush()
 
-            if self.notification_callback:
-                body = dict(
-                    badge=dict(
-                        name=badge.name,
-                        description=badge.description,
-                        image_url=badge.image,
-                        badge_id=badge_id,
-                    ),
-                    user=dict(username=person.nickname, badges_user_id=person.id),
-                )
-                self.notification_callback(BadgeAwardV1(body=body))
+            if self._notifying:
+                self._notify(queries.badge_award_message(badge_id, badge, person))
 
             return person_email, badge_id
 
         return False
 
+    @autocommit
+    def add_assertions(self, assertions):
+        """
+        Add many assertions (award badges) to the database at once
+
+        Persons and badges are looked up in bulk, the assertions are inserted
+        in a single statement and committed once (unless autocommit is off).
+        The notifications are sent after that. Assertions referring to an
+        unknown person or badge, and assertions that already exist, are
+        skipped.
+
+        :type assertions: iterable
+        :param assertions: Tuples of the arguments of :meth:`add_assertion`:
+            ``(badge_id, person_email[, issued_on[, issued_for]])``
+
+        :rtype: list
+        :returns: For each assertion, ``(person_email, badge_id)`` if it was
+            added, False otherwise.
+        """
+
+        items = [tuple(item) + (None,) * (4 - len(item)) for item in assertions]
+
+        emails = {item[1].lower() for item in items}
+        persons = {
+            person.email.lower(): person
+            for person in self.session.query(Person).filter(func.lower(Person.email).in_(emails))
+        }
+        badge_ids = {item[0].lower() for item in items}
+        badges = {
+            badge.id.lower(): badge
+            for badge in self.session.query(Badge).filter(func.lower(Badge.id).in_(badge_ids))
+        }
+
+        def assertion_id(item):
+            person = persons.get(item[1].lower())
+            badge = badges.get(item[0].lower())
+            if person is None or badge is None:
+                return None
+            return f"{badge.id} -> {person.id}"
+
+        existing = set(
+            self.session.scalars(
+                select(Assertion.id).where(Assertion.id.in_({assertion_id(i) for i in items}))
+            )
+        )
+
+        results = []
+        rows = []
+        messages = []
+        for badge_id, person_email, issued_on, issued_for in items:
+            new_id = assertion_id((badge_id, person_email))
+            if new_id is None or new_id in existing:
+                results.append(False)
+                continue
+            existing.add(new_id)
+            badge = badges[badge_id.lower()]
+            person = persons[person_email.lower()]
+            salt = salt_default(None)
+            rows.append(
+                dict(
+                    id=new_id,
+                    badge_id=badge.id,
+                    person_id=person.id,
+                    salt=salt,
+                    issued_on=issued_on or datetime.now(timezone.utc),
+                    issued_for=issued_for,
+                    recipient=get_assertion_recipient(person.email, salt),
+                )
+            )
+            messages.append(queries.badge_award_message(badge_id, badge, person))
+            results.append((person_email, badge_id))
+
+        if rows:
+            # This is a Core executemany, the ORM events maintaining the counts
+            # won't fire.
+            self.session.execute(insert(Assertion.__table__), rows)
+            update_assertion_counts(
+                self.session.connection(), [(r["person_id"], r["issued_on"]) for r in rows]
+            )
+            new_badges = {row["person_id"] for row in rows}
+            self._transaction().unranked_awards.update(row["person_id"] for row in rows)
+            for person in persons.values():
+                if person.id in new_badges:
+                    self.session.expire(person, ["badge_count"])
+            if self.shared_cache is not None:
+                stale_versions = self._transaction().stale_versions
+                stale_versions.add("leaderboard")
+                stale_versions.update(f"person:{person_id}" for person_id in new_badges)
+
+        for message in messages:
+            self._notify(message)
+
+        return results
+
     def get_current_value(self, badge_id, person_email):
         """
         Return the current value for the given badge and the given person's email
@@ -932,11 +1754,8 @@ class TahrirDatabase:
         if person is None:
             return None
 
-        query = select(CurrentValue.value).where(
-            CurrentValue.badge_id == badge_id,
-            CurrentValue.person_id == person.id,
-        )
-        return self.session.scalar(query)
+        query = queries.current_value(badge_id, person.id)
+        return self.session.scalar(query.with_only_columns(CurrentValue.value))
 
     def set_current_value(self, badge_id, person_email, value):
         """Set the current value for the given badge and the given person's email
@@ -957,11 +1776,7 @@ class TahrirDatabase:
             person = self.get_person(person_email=person_email)
 
         now = datetime.now(tz=timezone.utc)
-        query = select(CurrentValue).where(
-            CurrentValue.badge_id == badge_id,
-            CurrentValue.person_id == person.id,
-        )
-        current_value = self.session.scalar(query)
+        current_value = self.session.scalar(queries.current_value(badge_id, person.id))
         if current_value is None:
             current_value = CurrentValue(badge_id=badge_id, value=value, last_update=now)
             person.current_values.append(current_value)
@@ -970,7 +1785,46 @@ class TahrirDatabase:
             current_value.value = value
             current_value.last_update = now
 
-    def adjust_ranks(self, person):
+    def _rank_for_count(self, badges):
+        """Return the all-time rank shared by everyone holding ``badges`` badges."""
+        query = select(func.count(Person.id)).where(
+            queries.ranked_persons(), Person.badge_count > badges
+        )
+        return 1 + self.session.scalar(query)
+
+    def rebuild_ranks(self, verify=False):
+        """Recalculate the cached rank of every person from the full leaderboard.
+
+        This is the expensive repair path for :meth:`adjust_ranks`, e.g. for
+        the persons who were awarded badges before ranks were cached, or when
+        assertions were added without calling :meth:`adjust_ranks`. Only the
+        rows whose cached rank is wrong are updated.
+
+        :type verify: bool
+        :param verify: If True, only report the wrong ranks, don't fix them.
+
+        :rtype: dict
+        :returns: A dict mapping persons with a wrong cached rank to a tuple of
+            their cached rank and their expected rank.
+        """
+        mismatches = {}
+        # The ranks are fixed on the persons of the leaderboard, they must be
+        # read with the session which will write them.
+        with self.use_primary():
+            leaderboard = self.make_leaderboard()
+        for _person, data in leaderboard.items():
+            if _person.rank != data["rank"]:
+                mismatches[_person] = (_person.rank, data["rank"])
+                if not verify:
+                    _person.rank = data["rank"]
+
+        if not verify:
+            self.session.flush()
+            self._transaction().unranked_awards.clear()
+
+        return mismatches
+
+    def adjust_ranks(self, person, full=False):
         """Given a person model object, adjust the ranks of all persons between the 'old' rank and
         the present rank of the given person.
 
@@ -978,26 +1832,210 @@ class TahrirDatabase:
         new badge, and their rank advances.  Since we cache rank in the
         database, we want to also decrement the rank of all persons that the
         given person is "passing" on the all-time leaderboard.
+
+        The ranks are updated incrementally: when the person's badge count goes
+        from N to N+K, only the person and the persons who have N to N+K-1
+        badges (the tie groups the person just passed) change rank. K is the
+        number of badges awarded to the person through this API since their
+        ranks were last adjusted, or 1 if there is none. If ``full`` is True,
+        all ranks are recalculated with :meth:`rebuild_ranks` instead.
+
+        The other changes of the leaderboard, deleting assertions or ranked
+        persons and changing the opt-out setting of persons, rebuild all ranks
+        when they are committed.
         """
 
         old_rank = person.rank
 
-        # Build a dict of Persons to some freshly calculated rank info.
-        leaderboard = self.make_leaderboard()
+        self.session.flush()
+        awarded = self._transaction().unranked_awards.pop(person.id, 1)
+        badges = person.badge_count
+
+        if full:
+            self.rebuild_ranks()
+        elif badges and not person.opt_out:
+            # With rank being shared, a new badge doesn't always change the
+            # person's own position, but it always demotes the persons they
+            # were tied with, and the ones they passed.
+            person.rank = self._rank_for_count(badges)
+            passed = (
+                select(Person.badge_count)
+                .distinct()
+                .where(
+                    queries.ranked_persons(),
+                    Person.badge_count >= badges - awarded,
+                    Person.badge_count < badges,
+                )
+            )
+            for count in self.session.scalars(passed).all():
+                self.session.execute(
+                    update(Person)
+                    .where(queries.ranked_persons(), Person.badge_count == count)
+                    .values(rank=self._rank_for_count(count)),
+                    execution_options={"synchronize_session": "fetch"},
+                )
 
-        # Recalculate rank in all cases, otherwise "overtaking" won't work
-        # anymore (with rank being shared, a new badge won't change a person's
-        # own position, but needs to demote the rest).
+        self.session.flush()
 
-        # Otherwise, take our calculations and commit them to the db.
-        for _person, data in leaderboard.items():
-            _person.rank = data["rank"]
+        if self._notifying:
+            from tahrir_messages import PersonRankAdvanceV1
 
-        self.session.flush()
+            body = dict(person=person.as_dict(), old_rank=old_rank)
+            self._notify(PersonRankAdvanceV1(body=body))
+
+    def get_leaderboard(self, start=None, stop=None, limit=None, offset=None):
+        """Return a page of the leaderboard, ranked by the database.
+
+        Unlike :meth:`make_leaderboard`, the ranks are computed with a
+        ``RANK()`` window function and only lightweight rows are returned, so
+        rendering the top of the leaderboard doesn't load every person.
+
+        :type start: datetime
+        :param start: Only count the badges awarded after this date.
+
+        :type stop: datetime
+        :param stop: Only count the badges awarded before this date. As with
+            :meth:`make_leaderboard`, ``start`` and ``stop`` are ignored unless
+            both are given.
+
+        :type limit: int
+        :param limit: The maximum number of rows to return.
 
-        body = dict(person=person.as_dict(), old_rank=old_rank)
-        if self.notification_callback:
-            self.notification_callback(PersonRankAdvanceV1(body=body))
+        :type offset: int
+        :param offset: The number of rows to skip.
+
+        :rtype: list
+        :returns: LeaderboardEntry tuples of ``person_id``, ``nickname``,
+            ``badges`` and ``rank``, ordered by rank.
+        """
+        counts = queries.leaderboard_counts(start, stop).subquery()
+        rank = func.rank().over(order_by=counts.c.badges.desc()).label("rank")
+        query = (
+            select(counts.c.person_id, counts.c.nickname, counts.c.badges, rank)
+            .order_by(rank, counts.c.person_id)
+            .limit(limit)
+            .offset(offset)
+        )
+        return self._shared_cached(
+            "leaderboard",
+            ["leaderboard"],
+            (start, stop, limit, offset),
+            lambda: self._read_leaderboard(query),
+            restore=lambda rows: [LeaderboardEntry(*row) for row in rows],
+        )
+
+    def _read_leaderboard(self, query):
+        with self._reading() as session:
+            return [LeaderboardEntry(*row) for row in session.execute(query)]
+
+    def get_rank_context(self, person, radius=2, start=None, stop=None):
+        """Return the rank of a person and of their neighbours on the leaderboard.
+
+        This only looks at the persons around the given one, using the same
+        order as :meth:`get_leaderboard`, instead of ranking everybody.
+
+        :type person: Person
+        :param person: The person to look for.
+
+        :type radius: int
+        :param radius: The number of neighbours to return above and below the
+            person.
+
+        :type start: datetime
+        :param start: See :meth:`get_leaderboard`.
+
+        :type stop: datetime
+        :param stop: See :meth:`get_leaderboard`.
+
+        :rtype: dict
+        :returns: A dict with the person's ``rank`` and ``badges``, and the
+            ``above`` and ``below`` lists of neighbours as LeaderboardEntry
+            tuples, ordered by rank. Returns None if the person isn't on the
+            leaderboard.
+        """
+        return self._shared_cached(
+            "rank_context",
+            ["leaderboard"],
+            (person.id, radius, start, stop),
+            lambda: self._get_rank_context(person, radius, start, stop),
+            dump=lambda context: context,
+            restore=lambda context: context
+            and dict(
+                context,
+                above=[LeaderboardEntry(*row) for row in context["above"]],
+                below=[LeaderboardEntry(*row) for row in context["below"]],
+            ),
+        )
+
+    def _get_rank_context(self, person, radius, start, stop):
+        with self._reading() as session:
+            return self._rank_context(session, person, radius, start, stop)
+
+    def _rank_context(self, session, person, radius, start, stop):
+        counts = queries.leaderboard_counts(start, stop).subquery()
+        columns = (counts.c.person_id, counts.c.nickname, counts.c.badges)
+
+        me = session.execute(select(*columns).where(counts.c.person_id == person.id)).first()
+        if me is None:
+            return None
+
+        def with_at_least(badges):
+            # The persons ahead of a row have at least as many badges, the
+            # index of the badge counts limits the scans to them.
+            return queries.leaderboard_counts(start, stop, min_badges=badges).subquery()
+
+        ahead = with_at_least(me.badges)
+        above = session.execute(
+            select(ahead.c.person_id, ahead.c.nickname, ahead.c.badges)
+            .where(or_(ahead.c.badges > me.badges, ahead.c.person_id < me.person_id))
+            .order_by(ahead.c.badges, ahead.c.person_id.desc())
+            .limit(radius)
+        ).all()
+        below = session.execute(
+            select(*columns)
+            .where(
+                counts.c.badges <= me.badges,
+                or_(counts.c.badges < me.badges, counts.c.person_id > me.person_id),
+            )
+            .order_by(counts.c.badges.desc(), counts.c.person_id)
+            .limit(radius)
+        ).all()
+        rows = [*reversed(above), me, *below]
+
+        # Rank the first row, the others follow from their position.
+        first = rows[0]
+        ahead = with_at_least(first.badges)
+        greater, tied_ahead = session.execute(
+            select(
+                func.count(case((ahead.c.badges > first.badges, 1))),
+                func.count(
+                    case(
+                        (
+                            and_(
+                                ahead.c.badges == first.badges,
+                                ahead.c.person_id < first.person_id,
+                            ),
+                            1,
+                        )
+                    )
+                ),
+            )
+        ).one()
+        position = 1 + greater + tied_ahead
+        ranked = []
+        for index, row in enumerate(rows):
+            if not ranked:
+                rank = 1 + greater
+            elif row.badges != ranked[-1].badges:
+                rank = position + index
+            ranked.append(LeaderboardEntry(*row, rank))
+
+        return dict(
+            rank=ranked[len(above)].rank,
+            badges=me.badges,
+            above=ranked[: len(above)],
+            below=ranked[len(above) + 1 :],
+        )
 
     def make_leaderboard(self, start=None, stop=None):
         """Produce a dict mapping persons to information about
@@ -1019,45 +2057,6 @@ class TahrirDatabase:
         Moved here by Ralph Bean.
         """
 
-        leaderboard = self.session.query(
-            Person, func.count(Person.assertions).label("count_1")
-        ).join(Assertion)
-
-        if start and stop:
-            leaderboard = leaderboard.filter(Assertion.issued_on >= start).filter(
-                Assertion.issued_on <= stop
-            )
-
-        leaderboard = (
-            leaderboard.order_by(text("count_1 desc"))
-            .filter(not_(Person.opt_out))
-            .group_by(Person)
-            .all()
-        )
-
-        # Hackishly, but relatively cheaply get the rank of all users.
-        # This is:
-        # { <person object>:
-        #   {
-        #     'badges': <number of badges they have>,
-        #     'rank': <their global rank>
-        #   }
-        # }
-        #
-        # Tweaked so that users with the same amount of badges share rank.
-
-        user_to_rank = OrderedDict()
-
-        prev_rank, prev_badges = None, None
-
-        for idx, data in enumerate(leaderboard):
-            user, badges = data[0:2]
-            if badges == prev_badges:
-                # same amount of badges -> same rank
-                rank = prev_rank
-            else:
-                prev_rank = rank = idx + 1
-                prev_badges = badges
-            user_to_rank[user] = {"badges": badges, "rank": rank}
-
-        return user_to_rank
+        with self._reading() as session:
+            leaderboard = session.execute(queries.leaderboard(start, stop)).all()
+            return queries.rank_leaderboard(leaderboard)
@@ -0,0 +1,40 @@
+"""Add the assertion counts by period
+
+Revision ID: 5b7e0d3f9a21
+Revises: c3f1a9d2e6b4
+Create Date: 2026-10-17 12:26:09.530118
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "5b7e0d3f9a21"
+down_revision = "c3f1a9d2e6b4"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "assertion_counts_by_period",
+        sa.Column("person_id", sa.Integer(), nullable=False),
+        sa.Column("period", sa.Date(), nullable=False),
+        sa.Column("count", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["person_id"],
+            ["persons.id"],
+            name=op.f("fk_assertion_counts_by_period_person_id_persons"),
+        ),
+        sa.PrimaryKeyConstraint("person_id", "period", name=op.f("pk_assertion_counts_by_period")),
+    )
+    op.execute(
+        "INSERT INTO assertion_counts_by_period (person_id, period, count) "
+        "SELECT person_id, date(issued_on), COUNT(*) FROM assertions "
+        "GROUP BY person_id, date(issued_on)"
+    )
+
+
+def downgrade():
+    op.drop_table("assertion_counts_by_period")
@@ -0,0 +1,34 @@
+"""Add the outbox table
+
+Revision ID: 7c2d5e8f1b36
+Revises: e91b2f6c4d08
+Create Date: 2026-10-17 16:08:41.215734
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "7c2d5e8f1b36"
+down_revision = "e91b2f6c4d08"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "outbox",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("topic", sa.Unicode(length=255), nullable=False),
+        sa.Column("message", sa.UnicodeText(), nullable=False),
+        sa.Column("created_on", sa.DateTime(), nullable=False),
+        sa.Column("sent_on", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("id", name=op.f("pk_outbox")),
+    )
+    op.create_index(op.f("ix_outbox_sent_on"), "outbox", ["sent_on"], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f("ix_outbox_sent_on"), table_name="outbox")
+    op.drop_table("outbox")
@@ -0,0 +1,35 @@
+"""Add Person.badge_count
+
+Revision ID: 8e2a4c1d7b90
+Revises: 51261da641fb
+Create Date: 2026-10-17 10:12:31.402214
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "8e2a4c1d7b90"
+down_revision = "51261da641fb"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "persons",
+        sa.Column("badge_count", sa.Integer(), nullable=False, server_default="0"),
+    )
+    op.execute(
+        "UPDATE persons SET badge_count = "
+        "(SELECT COUNT(*) FROM assertions WHERE assertions.person_id = persons.id)"
+    )
+    op.create_index(
+        "ix_persons_opt_out_badge_count", "persons", ["opt_out", "badge_count"], unique=False
+    )
+
+
+def downgrade():
+    op.drop_index("ix_persons_opt_out_badge_count", table_name="persons")
+    op.drop_column("persons", "badge_count")
@@ -0,0 +1,32 @@
+"""Add indexes on assertions
+
+Revision ID: a4d86e2c1f57
+Revises: 5b7e0d3f9a21
+Create Date: 2026-10-17 13:41:47.602183
+"""
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "a4d86e2c1f57"
+down_revision = "5b7e0d3f9a21"
+branch_labels = None
+depends_on = None
+
+
+INDEXES = {
+    "ix_assertions_person_id_issued_on": ["person_id", "issued_on"],
+    "ix_assertions_badge_id_issued_on": ["badge_id", "issued_on"],
+    "ix_assertions_issued_on": ["issued_on"],
+}
+
+
+def upgrade():
+    for name, columns in INDEXES.items():
+        op.create_index(name, "assertions", columns, unique=False)
+
+
+def downgrade():
+    for name in INDEXES:
+        op.drop_index(name, table_name="assertions")
@@ -0,0 +1,36 @@
+"""Add indexes for case-insensitive lookups
+
+Revision ID: c3f1a9d2e6b4
+Revises: 8e2a4c1d7b90
+Create Date: 2026-10-17 11:03:54.118730
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "c3f1a9d2e6b4"
+down_revision = "8e2a4c1d7b90"
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ("ix_badges_lower_id", "badges", "id"),
+    ("ix_team_lower_id", "team", "id"),
+    ("ix_series_lower_id", "series", "id"),
+    ("ix_persons_lower_email", "persons", "email"),
+    ("ix_persons_lower_nickname", "persons", "nickname"),
+    ("ix_assertions_lower_badge_id", "assertions", "badge_id"),
+]
+
+
+def upgrade():
+    for name, table, column in INDEXES:
+        op.create_index(name, table, [sa.text(f"lower({column})")], unique=False)
+
+
+def downgrade():
+    for name, table, _column in INDEXES:
+        op.drop_index(name, table_name=table)
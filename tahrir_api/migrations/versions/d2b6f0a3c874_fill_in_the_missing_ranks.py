@@ -0,0 +1,31 @@
+"""Fill in the missing ranks
+
+The persons who were awarded badges before ranks were cached have no rank,
+adjusting the ranks after an award doesn't fill them in.
+
+Revision ID: d2b6f0a3c874
+Revises: 7c2d5e8f1b36
+Create Date: 2026-10-17 20:31:47.106593
+"""
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "d2b6f0a3c874"
+down_revision = "7c2d5e8f1b36"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(
+        "UPDATE persons SET rank = 1 + "
+        "(SELECT COUNT(*) FROM persons AS ahead "
+        "WHERE NOT ahead.opt_out AND ahead.badge_count > persons.badge_count) "
+        "WHERE NOT opt_out AND badge_count > 0"
+    )
+
+
+def downgrade():
+    pass
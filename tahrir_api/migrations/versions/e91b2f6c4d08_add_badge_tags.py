@@ -0,0 +1,44 @@
+"""Add the badge_tags table
+
+Revision ID: e91b2f6c4d08
+Revises: a4d86e2c1f57
+Create Date: 2026-10-17 14:52:18.744310
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "e91b2f6c4d08"
+down_revision = "a4d86e2c1f57"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    badge_tags = op.create_table(
+        "badge_tags",
+        sa.Column("badge_id", sa.Unicode(length=128), nullable=False),
+        sa.Column("tag", sa.Unicode(length=128), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["badge_id"], ["badges.id"], name=op.f("fk_badge_tags_badge_id_badges")
+        ),
+        sa.PrimaryKeyConstraint("badge_id", "tag", name=op.f("pk_badge_tags")),
+    )
+    op.create_index(op.f("ix_badge_tags_tag"), "badge_tags", ["tag"], unique=False)
+
+    # Backfill from the comma-delimited tags of the badges.
+    badges = sa.table("badges", sa.column("id"), sa.column("tags"))
+    connection = op.get_bind()
+    rows = []
+    for badge_id, tags in connection.execute(sa.select(badges.c.id, badges.c.tags)):
+        normalized = {tag.strip().lower() for tag in (tags or "").split(",")}
+        rows.extend(dict(badge_id=badge_id, tag=tag) for tag in normalized if tag)
+    if rows:
+        op.bulk_insert(badge_tags, rows)
+
+
+def downgrade():
+    op.drop_index(op.f("ix_badge_tags_tag"), table_name="badge_tags")
+    op.drop_table("badge_tags")
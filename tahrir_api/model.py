@@ -1,16 +1,60 @@
+import collections
 import datetime
+import functools
 import hashlib
 import time
 import uuid
 
-import arrow
-import pygments
-import simplejson
-from sqlalchemy import Column, DateTime, ForeignKey, select, Unicode, UniqueConstraint
-from sqlalchemy.orm import object_session, relationship
+from sqlalchemy import (
+    bindparam,
+    Column,
+    Date,
+    DateTime,
+    delete,
+    event,
+    ForeignKey,
+    func,
+    Index,
+    insert,
+    select,
+    Unicode,
+    UnicodeText,
+    UniqueConstraint,
+    update,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import attributes, object_session, relationship, validates
 from sqlalchemy.types import Boolean, Integer
 from sqlalchemy_helpers import Base as DeclarativeBase
 
+from .cache import LRUCache
+from .utils import parse_tags
+
+
+# The dialects supporting INSERT ... ON CONFLICT DO UPDATE
+UPSERT_DIALECTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+# The highlighted HTML, by hash of the JSON it was rendered from
+PYGMENTS_CACHE = LRUCache(maxsize=1024, ttl=None)
+
+
+@functools.lru_cache(maxsize=None)
+def pygments_renderers():
+    """Return the JSON encoder, lexer and HTML formatter used by Assertion.__pygments__.
+
+    They don't keep state between calls, so they are shared. Pygments is
+    slow to import, it is only imported when the first assertion is rendered.
+    """
+    import pygments.formatters
+    import pygments.lexers
+    import simplejson
+
+    return (
+        simplejson.encoder.JSONEncoder(indent=2),
+        pygments.lexers.JavascriptLexer(),
+        pygments.formatters.HtmlFormatter(full=False),
+    )
+
 
 class Issuer(DeclarativeBase):
     __tablename__ = "issuers"
@@ -54,11 +98,20 @@ class Badge(DeclarativeBase):
     invitations = relationship("Invitation", backref="badge")
     current_values = relationship("CurrentValue", back_populates="badge")
     created_on = Column(DateTime, nullable=False, default=datetime.datetime.now)
+    # Comma-delimited list of tags, the normalized tags are in badge_tags.
     tags = Column(Unicode(128))
+    badge_tags = relationship("BadgeTag", backref="badge", cascade="all, delete-orphan")
 
     def __str__(self):
         return str(self.name)
 
+    @validates("tags")
+    def _update_badge_tags(self, key, tags):
+        # Keep the normalized tags in sync, the tags lookups only use them.
+        existing = {badge_tag.tag: badge_tag for badge_tag in self.badge_tags}
+        self.badge_tags = [existing.get(tag) or BadgeTag(tag=tag) for tag in parse_tags(tags)]
+        return tags
+
     def as_dict(self):
         if self.image.startswith("http"):
             image = self.image
@@ -84,6 +137,19 @@ class Badge(DeclarativeBase):
         return False
 
 
+# Case-insensitive lookups filter on lower(...), which can't use the primary
+# key or unique indexes.
+Index("ix_badges_lower_id", func.lower(Badge.id))
+
+
+class BadgeTag(DeclarativeBase):
+    """A tag of a badge, lower-cased so that it can be looked up with an index."""
+
+    __tablename__ = "badge_tags"
+    badge_id = Column(Unicode(128), ForeignKey("badges.id"), primary_key=True, nullable=False)
+    tag = Column(Unicode(128), primary_key=True, nullable=False, index=True)
+
+
 class Team(DeclarativeBase):
     __tablename__ = "team"
     id = Column(Unicode(128), primary_key=True, default=generate_default_id)
@@ -95,6 +161,9 @@ class Team(DeclarativeBase):
         return dict(id=self.id, name=self.name, created_on=str(self.created_on))
 
 
+Index("ix_team_lower_id", func.lower(Team.id))
+
+
 class Series(DeclarativeBase):
     __tablename__ = "series"
     id = Column(Unicode(128), primary_key=True, default=generate_default_id)
@@ -121,6 +190,9 @@ class Series(DeclarativeBase):
         )
 
 
+Index("ix_series_lower_id", func.lower(Series.id))
+
+
 class Milestone(DeclarativeBase):
     __tablename__ = "milestone"
     __table_args__ = (UniqueConstraint("position", "badge_id", "series_id"),)
@@ -139,6 +211,7 @@ class Milestone(DeclarativeBase):
 
 class Person(DeclarativeBase):
     __tablename__ = "persons"
+    __table_args__ = (Index("ix_persons_opt_out_badge_count", "opt_out", "badge_count"),)
     id = Column(Integer, unique=True, primary_key=True)
     email = Column(Unicode(128), nullable=False, unique=True)
     _avatar = Column(Unicode(128), nullable=True)
@@ -156,6 +229,9 @@ class Person(DeclarativeBase):
     # badges they have ever been awarded.  A value of None
     # indicates that they have not been ranked yet at all.
     rank = Column(Integer, default=None)
+    # The number of assertions this person has, kept in sync when assertions
+    # are inserted or deleted (see update_assertion_counts below).
+    badge_count = Column(Integer, nullable=False, default=0, server_default="0")
 
     def __repr__(self):
         return f"<Person: '{self.nickname} <{self.email}>'"
@@ -182,6 +258,10 @@ class Person(DeclarativeBase):
         )
 
 
+Index("ix_persons_lower_email", func.lower(Person.email))
+Index("ix_persons_lower_nickname", func.lower(Person.nickname))
+
+
 def invitation_id_default(context):
     return hashlib.md5(salt_default(context).encode("utf-8")).hexdigest()
 
@@ -209,6 +289,8 @@ class Invitation(DeclarativeBase):
 
     @property
     def expires_on_relative(self):
+        import arrow
+
         return arrow.get(self.expires_on).humanize()
 
 
@@ -236,6 +318,8 @@ class CurrentValue(DeclarativeBase):
 
 
 def recipient_default(context):
+    # Fallback for when the recipient isn't computed by the caller, this costs
+    # an additional query for each inserted assertion.
     person_id = context.current_parameters["person_id"]
     salt = context.current_parameters["salt"]
     person_email = context.connection.scalar(select(Person.email).where(Person.id == person_id))
@@ -258,6 +342,11 @@ def assertion_id_default(context):
 
 class Assertion(DeclarativeBase):
     __tablename__ = "assertions"
+    __table_args__ = (
+        Index("ix_assertions_person_id_issued_on", "person_id", "issued_on"),
+        Index("ix_assertions_badge_id_issued_on", "badge_id", "issued_on"),
+        Index("ix_assertions_issued_on", "issued_on"),
+    )
     id = Column(Unicode(128), primary_key=True, unique=True, default=assertion_id_default)
     badge_id = Column(Unicode(128), ForeignKey("badges.id"), nullable=False)
     person_id = Column(Integer, ForeignKey("persons.id"), nullable=False)
@@ -293,11 +382,143 @@ class Assertion(DeclarativeBase):
         return lambda: session.delete(self)
 
     def __pygments__(self):
-        html_args = {"full": False}
-        pretty_encoder = simplejson.encoder.JSONEncoder(indent=2)
-        html = pygments.highlight(
-            pretty_encoder.encode(self.as_dict()),
-            pygments.lexers.JavascriptLexer(),
-            pygments.formatters.HtmlFormatter(**html_args),
-        ).strip()
+        encoder, lexer, formatter = pygments_renderers()
+        source = encoder.encode(self.as_dict())
+        # Keyed by content, a changed assertion, badge or issuer is rendered again.
+        key = hashlib.sha256(source.encode("utf-8")).hexdigest()
+        html = PYGMENTS_CACHE.get(key)
+        if html is None:
+            import pygments
+
+            html = pygments.highlight(source, lexer, formatter).strip()
+            PYGMENTS_CACHE.set(key, html)
         return html
+
+
+Index("ix_assertions_lower_badge_id", func.lower(Assertion.badge_id))
+
+
+class AssertionCount(DeclarativeBase):
+    """The number of assertions a person was awarded on a given day.
+
+    This is maintained along with the assertions so that the leaderboards over
+    a period of time don't have to count the assertions again.
+    """
+
+    __tablename__ = "assertion_counts_by_period"
+    person_id = Column(Integer, ForeignKey("persons.id"), primary_key=True, nullable=False)
+    period = Column(Date, primary_key=True, nullable=False)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class OutboxMessage(DeclarativeBase):
+    """A notification saved in the transaction that caused it, waiting to be published.
+
+    The ``message`` is the fedora-messaging serialization of the message.
+    Pending messages have no ``sent_on`` date.
+    """
+
+    __tablename__ = "outbox"
+    id = Column(Integer, primary_key=True)
+    topic = Column(Unicode(255), nullable=False)
+    message = Column(UnicodeText, nullable=False)
+    created_on = Column(DateTime, nullable=False, default=datetime.datetime.now)
+    sent_on = Column(DateTime, nullable=True, default=None, index=True)
+
+
+def update_assertion_counts(connection, assertions, delta=1):
+    """Update the badge counts of persons and the assertion counts by period.
+
+    :type assertions: iterable
+    :param assertions: (person_id, issued_on) tuples of the assertions that
+        were inserted or deleted.
+
+    :type delta: int
+    :param delta: 1 if the assertions were inserted, -1 if they were deleted.
+    """
+    by_person = collections.Counter()
+    by_period = collections.Counter()
+    for person_id, issued_on in assertions:
+        by_person[person_id] += delta
+        by_period[(person_id, issued_on.date())] += delta
+
+    persons = Person.__table__
+    connection.execute(
+        update(persons)
+        .where(persons.c.id == bindparam("_person_id"))
+        .values(badge_count=persons.c.badge_count + bindparam("_delta")),
+        [dict(_person_id=person_id, _delta=count) for person_id, count in by_person.items()],
+    )
+
+    counts = AssertionCount.__table__
+    rows = [
+        dict(person_id=person_id, period=period, count=count)
+        for (person_id, period), count in by_period.items()
+    ]
+    if connection.dialect.name in UPSERT_DIALECTS:
+        upsert = UPSERT_DIALECTS[connection.dialect.name](counts)
+        upsert = upsert.on_conflict_do_update(
+            index_elements=[counts.c.person_id, counts.c.period],
+            set_=dict(count=counts.c.count + upsert.excluded.count),
+        )
+        connection.execute(upsert, rows)
+    else:
+        _update_or_insert_counts(connection, rows)
+
+    if delta < 0:
+        # Drop the emptied days, they would keep the persons from being deleted.
+        connection.execute(
+            delete(counts).where(
+                counts.c.person_id.in_(by_person),
+                counts.c.period.in_({r["period"] for r in rows}),
+                counts.c.count <= 0,
+            )
+        )
+
+
+def _update_or_insert_counts(connection, rows):
+    counts = AssertionCount.__table__
+    existing = set(
+        connection.execute(
+            select(counts.c.person_id, counts.c.period).where(
+                counts.c.person_id.in_({r["person_id"] for r in rows}),
+                counts.c.period.in_({r["period"] for r in rows}),
+            )
+        )
+    )
+    updated = [r for r in rows if (r["person_id"], r["period"]) in existing]
+    inserted = [r for r in rows if (r["person_id"], r["period"]) not in existing]
+    if updated:
+        connection.execute(
+            update(counts)
+            .where(
+                counts.c.person_id == bindparam("_person_id"),
+                counts.c.period == bindparam("_period"),
+            )
+            .values(count=counts.c.count + bindparam("_count")),
+            [
+                dict(_person_id=r["person_id"], _period=r["period"], _count=r["count"])
+                for r in updated
+            ],
+        )
+    if inserted:
+        connection.execute(insert(counts), inserted)
+
+
+def _update_counts(connection, assertion, delta):
+    update_assertion_counts(connection, [(assertion.person_id, assertion.issued_on)], delta)
+    # Keep an already loaded Person in sync without emitting a query.
+    session = object_session(assertion)
+    person = session.identity_map.get(session.identity_key(Person, assertion.person_id))
+    if person is not None and "badge_count" in attributes.instance_dict(person):
+        attributes.set_committed_value(person, "badge_count", person.badge_count + delta)
+
+
+@event.listens_for(Assertion, "after_insert")
+def _increment_counts(mapper, connection, assertion):
+    _update_counts(connection, assertion, 1)
+
+
+@event.listens_for(Assertion, "after_delete")
+def _decrement_counts(mapper, connection, assertion):
+    _update_counts(connection, assertion, -1)
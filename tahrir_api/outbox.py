@@ -0,0 +1,102 @@
+""" Publishing of the notifications saved in the outbox table. """
+
+import datetime
+import json
+
+from sqlalchemy import select
+
+from .model import OutboxMessage
+
+
+def dump_message(message):
+    """Return an outbox row for this message."""
+    # fedora_messaging is slow to import, and not needed without an outbox.
+    from fedora_messaging import message as fm_message
+
+    return OutboxMessage(topic=message.topic, message=fm_message.dumps(message))
+
+
+def load_message(row):
+    """Return the message saved in this outbox row."""
+    from fedora_messaging import message as fm_message
+
+    return fm_message.load_message(json.loads(row.message))
+
+
+class Publisher:
+    """The interface of the publishers used to drain the outbox."""
+
+    def publish(self, messages):
+        """Publish a batch of messages, raising an exception if it failed."""
+        raise NotImplementedError
+
+
+class FedoraMessagingPublisher(Publisher):
+    """Publish the messages to the message bus with fedora-messaging."""
+
+    def publish(self, messages):
+        from fedora_messaging import api as fm_api
+
+        for message in messages:
+            fm_api.publish(message)
+
+
+class MemoryPublisher(Publisher):
+    """Keep the published messages in a list, for tests."""
+
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, messages):
+        self.messages.extend(messages)
+
+
+def drain_outbox(session, publisher, batch_size=100, limit=None):
+    """
+    Publish the pending messages of the outbox, oldest first, and mark them sent
+
+    Each batch is committed after it was published, so a failure leaves the
+    messages of the current batch pending, and they will be published again
+    by the next drain: the delivery is at least once. On databases supporting
+    it, the rows being published are locked and skipped by concurrent drains.
+
+    :type session: SQLAlchemy session object
+    :param session: The session to read the outbox with.
+
+    :type publisher: Publisher
+    :param publisher: The publisher to send the messages with.
+
+    :type batch_size: int
+    :param batch_size: The number of messages to publish at once.
+
+    :type limit: int
+    :param limit: The maximum number of messages to publish, all pending
+        messages are published if None.
+
+    :rtype: int
+    :returns: The number of published messages.
+    """
+
+    sent = 0
+    while limit is None or sent < limit:
+        size = batch_size if limit is None else min(batch_size, limit - sent)
+        rows = session.scalars(
+            select(OutboxMessage)
+            .where(OutboxMessage.sent_on.is_(None))
+            .order_by(OutboxMessage.id)
+            .limit(size)
+            .with_for_update(skip_locked=True)
+        ).all()
+        if not rows:
+            break
+        try:
+            publisher.publish([load_message(row) for row in rows])
+        except Exception:
+            session.rollback()
+            raise
+        now = datetime.datetime.now()
+        for row in rows:
+            row.sent_on = now
+        session.commit()
+        sent += len(rows)
+    return sent
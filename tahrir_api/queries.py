@@ -0,0 +1,223 @@
+""" Query construction and result processing shared by the sync and async APIs. """
+
+from collections import OrderedDict
+from datetime import datetime, time, timedelta
+
+from sqlalchemy import and_, func, not_, select, union_all
+
+from .model import Assertion, AssertionCount, Badge, CurrentValue, Issuer, Person, Series, Team
+
+
+def exists(query):
+    """Return a select of whether the given select matches at least one row, using EXISTS."""
+    return select(query.exists())
+
+
+def team(team_id):
+    return select(Team).where(func.lower(Team.id) == func.lower(team_id))
+
+
+def series(series_id):
+    return select(Series).where(func.lower(Series.id) == func.lower(series_id))
+
+
+def badge(badge_id):
+    return select(Badge).where(func.lower(Badge.id) == func.lower(badge_id))
+
+
+def issuer(issuer_id):
+    return select(Issuer).where(Issuer.id == issuer_id)
+
+
+def person_by_email(email):
+    return select(Person).where(func.lower(Person.email) == func.lower(email))
+
+
+def person_by_id(person_id):
+    return select(Person).where(Person.id == person_id)
+
+
+def person_by_nickname(nickname):
+    return select(Person).where(func.lower(Person.nickname) == func.lower(nickname))
+
+
+def person_lookups(email=None, id=None, nickname=None):
+    """Return the selects to try in order to find a person, see ``get_person()``."""
+    lookups = []
+    if email:
+        lookups.append(person_by_email(email))
+    if id:
+        lookups.append(person_by_id(id))
+    if nickname:
+        lookups.append(person_by_nickname(nickname))
+    return lookups
+
+
+def assertions_of_person(person_id):
+    return select(Assertion).where(Assertion.person_id == person_id)
+
+
+def assertion_export(badge_id=None, person_id=None):
+    """Return a select of the assertion columns in ``as_dict()``, with their badge and issuer."""
+    query = (
+        select(
+            Assertion.salt,
+            Assertion.recipient,
+            Assertion.issued_on,
+            Badge.id.label("badge_id"),
+            Badge.name.label("badge_name"),
+            Badge.image.label("badge_image"),
+            Badge.description.label("badge_description"),
+            Badge.criteria.label("badge_criteria"),
+            Badge.created_on.label("badge_created_on"),
+            Badge.tags.label("badge_tags"),
+            Issuer.id.label("issuer_id"),
+            Issuer.origin.label("issuer_origin"),
+            Issuer.name.label("issuer_name"),
+            Issuer.org.label("issuer_org"),
+            Issuer.contact.label("issuer_contact"),
+            Issuer.created_on.label("issuer_created_on"),
+        )
+        .join(Badge, Assertion.badge_id == Badge.id)
+        .join(Issuer, Badge.issuer_id == Issuer.id)
+        .order_by(Assertion.id)
+    )
+    if badge_id is not None:
+        query = query.where(Assertion.badge_id == badge_id)
+    if person_id is not None:
+        query = query.where(Assertion.person_id == person_id)
+    return query
+
+
+def current_value(badge_id, person_id):
+    return select(CurrentValue).where(
+        CurrentValue.badge_id == badge_id,
+        CurrentValue.person_id == person_id,
+    )
+
+
+def ranked_persons():
+    """Return the criteria selecting the persons on the all-time leaderboard."""
+    return and_(not_(Person.opt_out), Person.badge_count > 0)
+
+
+def leaderboard_counts(start, stop, min_badges=1):
+    """Return a select of (person_id, nickname, badges) for the leaderboard.
+
+    Only the persons with at least ``min_badges`` badges are selected. On the
+    all-time leaderboard, this is the only bound of the badge counts, so that
+    the index scan is limited to them.
+    """
+    if start and stop:
+        counts = period_counts(start, stop).subquery()
+        total = func.sum(counts.c.badges)
+        return (
+            select(Person.id.label("person_id"), Person.nickname, total.label("badges"))
+            .join(counts, counts.c.person_id == Person.id)
+            .where(not_(Person.opt_out))
+            .group_by(Person.id, Person.nickname)
+            .having(total >= max(min_badges, 1))
+        )
+    return select(
+        Person.id.label("person_id"),
+        Person.nickname,
+        Person.badge_count.label("badges"),
+    ).where(not_(Person.opt_out), Person.badge_count >= max(min_badges, 1))
+
+
+def period_counts(start, stop):
+    """Return a select of (person_id, badges) rows for the assertions between two dates.
+
+    The days entirely within the period are read from the pre-aggregated
+    assertion counts, the assertions are only counted on the partial days
+    at both ends.
+    """
+    first_day = start.date()
+    if start.time() != time(0):
+        first_day += timedelta(days=1)
+    last_day = stop.date() - timedelta(days=1)
+
+    def count_assertions(*criteria):
+        return (
+            select(Assertion.person_id, func.count(Assertion.id).label("badges"))
+            .where(*criteria)
+            .group_by(Assertion.person_id)
+        )
+
+    if first_day > last_day:
+        return count_assertions(Assertion.issued_on >= start, Assertion.issued_on <= stop)
+
+    first_day_start = datetime.combine(first_day, time(0), tzinfo=start.tzinfo)
+    last_day_end = datetime.combine(last_day + timedelta(days=1), time(0), tzinfo=stop.tzinfo)
+    return union_all(
+        select(AssertionCount.person_id, AssertionCount.count.label("badges")).where(
+            AssertionCount.period >= first_day, AssertionCount.period <= last_day
+        ),
+        count_assertions(Assertion.issued_on >= start, Assertion.issued_on < first_day_start),
+        count_assertions(Assertion.issued_on >= last_day_end, Assertion.issued_on <= stop),
+    )
+
+
+def leaderboard(start=None, stop=None):
+    """Return a select of (person, badges) rows, ordered by badges, see ``make_leaderboard()``."""
+    if start and stop:
+        counts = leaderboard_counts(start, stop).subquery()
+        return (
+            select(Person, counts.c.badges)
+            .join(counts, counts.c.person_id == Person.id)
+            .order_by(counts.c.badges.desc())
+        )
+    # The all-time leaderboard uses the materialized badge count, which is an
+    # indexed scan instead of an aggregate over all assertions.
+    return (
+        select(Person, Person.badge_count)
+        .where(ranked_persons())
+        .order_by(Person.badge_count.desc())
+    )
+
+
+def rank_leaderboard(leaderboard):
+    """Return the leaderboard dict of ``make_leaderboard()`` from (person, badges) rows."""
+
+    # Hackishly, but relatively cheaply get the rank of all users.
+    # This is:
+    # { <person object>:
+    #   {
+    #     'badges': <number of badges they have>,
+    #     'rank': <their global rank>
+    #   }
+    # }
+    #
+    # Tweaked so that users with the same amount of badges share rank.
+
+    user_to_rank = OrderedDict()
+
+    prev_rank, prev_badges = None, None
+
+    for idx, data in enumerate(leaderboard):
+        user, badges = data[0:2]
+        if badges == prev_badges:
+            # same amount of badges -> same rank
+            rank = prev_rank
+        else:
+            prev_rank = rank = idx + 1
+            prev_badges = badges
+        user_to_rank[user] = {"badges": badges, "rank": rank}
+
+    return user_to_rank
+
+
+def badge_award_message(badge_id, badge, person):
+    # tahrir_messages imports fedora_messaging, which is slow to import.
+    from tahrir_messages import BadgeAwardV1
+
+    body = dict(
+        badge=dict(
+            name=badge.name,
+            description=badge.description,
+            image_url=badge.image,
+            badge_id=badge_id,
+        ),
+        user=dict(username=person.nickname, badges_user_id=person.id),
+    )
+    return BadgeAwardV1(body=body)
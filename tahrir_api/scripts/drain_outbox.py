@@ -0,0 +1,46 @@
+import importlib
+import time
+
+import click
+
+from ..outbox import drain_outbox
+from .utils import get_db_manager_from_config
+
+
+def load_publisher(path):
+    """Return a publisher from the path of its class or factory, as ``module:name``."""
+    module_name, _sep, name = path.partition(":")
+    try:
+        factory = getattr(importlib.import_module(module_name), name)
+    except (ImportError, AttributeError) as e:
+        raise click.BadParameter(f"Can't load the publisher {path!r}: {e}") from e
+    return factory()
+
+
+@click.command()
+@click.argument("config", type=click.Path(exists=True))
+@click.option(
+    "--publisher",
+    default="tahrir_api.outbox:FedoraMessagingPublisher",
+    show_default=True,
+    help="The publisher class or factory, as module:name",
+)
+@click.option("--batch-size", default=100, show_default=True, help="Messages published at once")
+@click.option("--limit", type=int, default=None, help="The maximum number of messages to publish")
+@click.option(
+    "--interval",
+    type=float,
+    default=None,
+    help="Keep draining the outbox, waiting this many seconds when it's empty",
+)
+def main(config, publisher, batch_size, limit, interval):
+    publisher = load_publisher(publisher)
+    db_mgr = get_db_manager_from_config(config)
+    with db_mgr.Session() as session:
+        while True:
+            sent = drain_outbox(session, publisher, batch_size=batch_size, limit=limit)
+            click.echo(f"Published {sent} messages.")
+            if interval is None:
+                break
+            if not sent:
+                time.sleep(interval)
@@ -1,19 +1,40 @@
 """ Module to keep random utils. """
 
 import importlib.resources
+from time import monotonic
 
+from sqlalchemy import event
+from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy_helpers import DatabaseManager
 
 
 def autocommit(func):
     """A decorator that autocommits after API calls unless
     configured otherwise.
+
+    The commit can be deferred by batches and group commits, see
+    ``TahrirDatabase.batch()``.
     """
 
     def _wrapper(self, *args, **kwargs):
         result = func(self, *args, **kwargs)
         if self.autocommit:
-            self.session.commit()
+            self._autocommit()
+        return result
+
+    _wrapper.__name__ = func.__name__
+    _wrapper.__doc__ = func.__doc__
+
+    return _wrapper
+
+
+def async_autocommit(func):
+    """The :func:`autocommit` decorator, for coroutines."""
+
+    async def _wrapper(self, *args, **kwargs):
+        result = await func(self, *args, **kwargs)
+        if self.autocommit:
+            await self.session.commit()
         return result
 
     _wrapper.__name__ = func.__name__
@@ -39,10 +60,82 @@ def convert_name_to_id(name):
     return badge_id
 
 
-def get_db_manager_from_uri(uri):
+def parse_tags(tags):
+    """
+    Split a comma-delimited list of badge tags into normalized tags.
+
+    :type tags: string
+    :param tags: The comma-delimited list of tags
+    """
+
+    if not tags:
+        return []
+    return list(dict.fromkeys(tag.strip().lower() for tag in tags.split(",") if tag.strip()))
+
+
+def get_db_manager_from_uri(uri, engine_args=None):
+    from .model import DeclarativeBase  # noqa: F401
+
+    with importlib.resources.as_file(
+        importlib.resources.files("tahrir_api").joinpath("migrations")
+    ) as alembic_path:
+        return DatabaseManager(uri, alembic_path.as_posix(), engine_args=engine_args)
+
+
+def get_session_factory(engine, **options):
+    """Return a scoped session factory on an existing engine, like the DatabaseManager's."""
+    return scoped_session(sessionmaker(autoflush=False, bind=engine, **options))
+
+
+def set_statement_timeout(engine, timeout):
+    """
+    Abort the statements running for longer than a timeout, on all connections of an engine
+
+    :type engine: sqlalchemy.engine.Engine
+    :param engine: The engine to configure, before it opens connections.
+
+    :type timeout: float
+    :param timeout: The timeout in seconds.
+    """
+
+    dialect = engine.dialect.name
+    if dialect == "postgresql":
+        setting = f"SET statement_timeout = {int(timeout * 1000)}"
+    elif dialect == "mysql":
+        setting = f"SET SESSION max_execution_time = {int(timeout * 1000)}"
+    elif dialect != "sqlite":
+        raise ValueError(f"Statement timeouts are not supported with {dialect}")
+
+    @event.listens_for(engine, "connect")
+    def _connect(dbapi_connection, connection_record):
+        if dialect == "sqlite":
+            # SQLite has no setting for this, but aborts the statement when a
+            # progress handler returns True.
+            info = connection_record.info
+
+            def _progress():
+                start = info.get("statement_start")
+                return start is not None and monotonic() - start > timeout
+
+            dbapi_connection.set_progress_handler(_progress, 1000)
+            return
+        cursor = dbapi_connection.cursor()
+        cursor.execute(setting)
+        cursor.close()
+
+    if dialect == "sqlite":
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info["statement_start"] = monotonic()
+
+
+def get_async_db_manager_from_uri(uri):
+    from sqlalchemy_helpers.aio import AsyncDatabaseManager
+
     from .model import DeclarativeBase  # noqa: F401
 
     with importlib.resources.as_file(
         importlib.resources.files("tahrir_api").joinpath("migrations")
     ) as alembic_path:
-        return DatabaseManager(uri, alembic_path.as_posix())
+        return AsyncDatabaseManager(uri, alembic_path.as_posix())
@@ -1,4 +1,5 @@
 import pytest
+from sqlalchemy import event
 
 from tahrir_api.dbapi import TahrirDatabase
 from tahrir_api.utils import get_db_manager_from_uri
@@ -19,3 +20,37 @@ def api(callback_calls, tmp_path):
     db_mgr = get_db_manager_from_uri(db_uri)
     db_mgr.sync()
     return db_api
+
+
+@pytest.fixture
+def badge(api):
+    issuer_id = api.add_issuer("TestOrigin", "TestName", "TestOrg", "TestContact")
+    return api.add_badge("TestBadge", "TestImage", "A test badge", "TestCriteria", issuer_id)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    """A clock to pass instead of time.monotonic, which only moves when told to."""
+    return FakeClock()
+
+
+@pytest.fixture
+def statements(api):
+    """Record the SQL statements sent to the database by the API."""
+    executed = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+
+    engine = api.session.get_bind()
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    yield executed
+    event.remove(engine, "before_cursor_execute", before_cursor_execute)
@@ -0,0 +1,170 @@
+import asyncio
+import gc
+import weakref
+from datetime import datetime
+
+import pytest
+
+from tahrir_api.aio import AsyncTahrirDatabase
+from tahrir_api.utils import get_async_db_manager_from_uri
+
+
+pytest.importorskip("aiosqlite")
+
+
+@pytest.fixture
+def async_api(api, callback_calls):
+    """An async API on the database of the sync one, which has a badge and two persons."""
+    issuer_id = api.add_issuer("TestOrigin", "TestName", "TestOrg", "TestContact")
+    api.add_badge("TestBadge", "TestImage", "A test badge", "TestCriteria", issuer_id)
+    api.add_badge("OtherBadge", "TestImage", "Another badge", "TestCriteria", issuer_id)
+    api.add_person("alice@example.com")
+    api.add_person("bob@example.com")
+    api.session.close()
+
+    def callback(*args, **kwargs):
+        callback_calls.append((args, kwargs))
+
+    return lambda: AsyncTahrirDatabase(
+        dburi=str(api.session.get_bind().url), notification_callback=callback
+    )
+
+
+def run(async_api, coroutine_function):
+    async def main():
+        db = async_api()
+        try:
+            return await coroutine_function(db)
+        finally:
+            await db.close()
+
+    return asyncio.run(main())
+
+
+def test_constructor():
+    with pytest.raises(ValueError):
+        AsyncTahrirDatabase()
+
+
+def test_lookups(async_api):
+    async def lookups(db):
+        assert await db.badge_exists("TESTBADGE")
+        assert not await db.badge_exists("missing")
+        assert (await db.get_badge("TestBadge")).name == "TestBadge"
+        assert await db.person_exists(email="Alice@Example.com")
+        assert not await db.person_exists()
+        person = await db.get_person(nickname="bob")
+        assert person.email == "bob@example.com"
+        assert (await db.get_person(id=person.id)) is person
+        assert await db.get_person("missing@example.com") is None
+        assert not await db.person_opted_out("alice@example.com")
+        assert (await db.get_issuer(1)).name == "TestName"
+        assert await db.get_team("missing") is None
+        assert await db.get_assertions_by_email("missing@example.com") is False
+
+    run(async_api, lookups)
+
+
+def test_add_assertion(api, async_api, callback_calls):
+    async def award(db):
+        assert await db.add_assertion("testbadge", "alice@example.com", None) == (
+            "alice@example.com",
+            "testbadge",
+        )
+        assert await db.add_assertion("missing", "alice@example.com", None) is False
+        assertions = await db.get_assertions_by_email("alice@example.com")
+        return [assertion.id for assertion in assertions]
+
+    assert run(async_api, award) == ["testbadge -> 1"]
+    assert len(callback_calls) == 1
+    assert callback_calls[0][0][0].body["badge"]["badge_id"] == "testbadge"
+
+    # The assertion was committed, and the counts updated.
+    assert api.get_person("alice@example.com").badge_count == 1
+
+
+def test_make_leaderboard(api, async_api):
+    async def leaderboards(db):
+        await db.add_assertion("testbadge", "alice@example.com", datetime(2024, 1, 1))
+        await db.add_assertion("testbadge", "bob@example.com", datetime(2024, 1, 10))
+        await db.add_assertion("otherbadge", "bob@example.com", datetime(2024, 1, 11))
+        all_time = await db.make_leaderboard()
+        period = await db.make_leaderboard(datetime(2024, 1, 1), datetime(2024, 1, 10, 12))
+        return (
+            {person.nickname: data for person, data in all_time.items()},
+            {person.nickname: data for person, data in period.items()},
+        )
+
+    all_time, period = run(async_api, leaderboards)
+    assert all_time == {"bob": {"badges": 2, "rank": 1}, "alice": {"badges": 1, "rank": 2}}
+    assert period == {"alice": {"badges": 1, "rank": 1}, "bob": {"badges": 1, "rank": 1}}
+    assert {p.nickname: d for p, d in api.make_leaderboard().items()} == all_time
+
+
+def test_current_value(async_api):
+    async def current_value(db):
+        assert await db.get_current_value("testbadge", "alice@example.com") is None
+        await db.set_current_value("testbadge", "alice@example.com", 5)
+        assert await db.get_current_value("testbadge", "alice@example.com") == 5
+        await db.set_current_value("testbadge", "alice@example.com", 6)
+        await db.set_current_value("testbadge", "carol@example.com", 1)
+        await db.commit()
+        with pytest.raises(ValueError):
+            await db.get_current_value("missing", "alice@example.com")
+        return (
+            await db.get_current_value("testbadge", "alice@example.com"),
+            await db.get_current_value("testbadge", "carol@example.com"),
+        )
+
+    assert run(async_api, current_value) == (6, 1)
+
+
+def test_rollback(async_api, callback_calls):
+    async def rollback(db):
+        db.autocommit = False
+        await db.add_assertion("testbadge", "alice@example.com", None)
+        await db.rollback()
+        await db.commit()
+        return await db.get_assertions_by_email("alice@example.com")
+
+    assert run(async_api, rollback) == []
+    assert callback_calls == []
+
+
+def test_notifications_errors(async_api, callback_calls, caplog):
+    async def award(db):
+        def callback(message):
+            if not callback_calls:
+                callback_calls.append(None)
+                raise RuntimeError("The broker is down")
+            callback_calls.append(message)
+
+        db.notification_callback = callback
+        db.autocommit = False
+        await db.add_assertion("testbadge", "alice@example.com", None)
+        await db.add_assertion("testbadge", "bob@example.com", None)
+        await db.commit()
+        # The session still works.
+        return len(await db.get_assertions_by_email("alice@example.com"))
+
+    assert run(async_api, award) == 1
+    assert "Could not send the notification" in caplog.text
+    assert [message.body["user"]["username"] for message in callback_calls[1:]] == ["bob"]
+
+
+def test_listeners_released(api):
+    session = get_async_db_manager_from_uri(str(api.session.get_bind().url)).Session()
+
+    def count_listeners():
+        return len(list(session.sync_session.dispatch.after_commit))
+
+    listeners = count_listeners()
+
+    async def close():
+        await AsyncTahrirDatabase(session=session).close()
+
+    asyncio.run(close())
+    instances = [weakref.ref(AsyncTahrirDatabase(session=session)) for _ in range(100)]
+    gc.collect()
+    assert all(instance() is None for instance in instances)
+    assert count_listeners() == listeners
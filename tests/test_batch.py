@@ -0,0 +1,101 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import event
+
+from tahrir_api.model import Person
+
+
+@pytest.fixture
+def commits(api):
+    committed = []
+    event.listen(api.session, "after_commit", committed.append)
+    return committed
+
+
+def test_batch(api, badge, commits, callback_calls):
+    commits.clear()
+    with api.batch():
+        assert api.add_person("alice@example.com") == "alice@example.com"
+        assert api.add_person("bob@example.com") == "bob@example.com"
+        assert api.add_assertion(badge, "alice@example.com", None) == (
+            "alice@example.com",
+            badge,
+        )
+        assert commits == []
+        assert callback_calls == []
+    assert len(commits) == 1
+    assert len(callback_calls) == 1
+    assert api.session.query(Person).count() == 2
+
+
+def test_batch_nested(api, badge, commits, callback_calls):
+    commits.clear()
+    with api.batch():
+        with api.batch():
+            api.add_person("alice@example.com")
+            api.add_assertion(badge, "alice@example.com", None)
+        assert commits == []
+        api.add_assertions([(badge, "alice@example.com")])
+        assert callback_calls == []
+    assert len(commits) == 1
+    assert len(callback_calls) == 1
+
+
+def test_batch_rollback(api, badge, callback_calls):
+    with pytest.raises(RuntimeError):
+        with api.batch():
+            api.add_person("alice@example.com")
+            api.add_assertion(badge, "alice@example.com", None)
+            raise RuntimeError("Failed")
+    assert callback_calls == []
+    assert not api.person_exists(email="alice@example.com")
+
+    # The notifications of the failed batch are not sent later.
+    api.add_person("bob@example.com")
+    api.add_assertion(badge, "bob@example.com", None)
+    assert len(callback_calls) == 1
+
+
+def test_batch_commit_failure(api, badge, callback_calls, monkeypatch):
+    def fail():
+        raise RuntimeError("Failed")
+
+    with pytest.raises(RuntimeError):
+        with api.batch():
+            api.add_person("alice@example.com")
+            api.add_assertion(badge, "alice@example.com", None)
+            monkeypatch.setattr(api.session, "commit", fail)
+    assert callback_calls == []
+
+
+def test_commit_every(api, badge, commits, callback_calls):
+    api.commit_every = 3
+    commits.clear()
+    api.add_person("alice@example.com")
+    api.add_assertion(badge, "alice@example.com", None)
+    assert commits == []
+    assert callback_calls == []
+    api.add_person("bob@example.com")
+    assert len(commits) == 1
+    assert len(callback_calls) == 1
+
+    api.add_person("carol@example.com")
+    assert len(commits) == 1
+    api.commit()
+    assert len(commits) == 2
+
+
+def test_commit_interval(api, badge, commits, callback_calls, monkeypatch, clock):
+    monkeypatch.setattr("tahrir_api.dbapi.monotonic", clock)
+    api.commit_interval = 10
+    commits.clear()
+    api.add_person("alice@example.com")
+    clock.now = 9
+    api.add_assertion(badge, "alice@example.com", datetime(2024, 1, 1))
+    assert commits == []
+    assert callback_calls == []
+    clock.now = 10
+    api.add_person("bob@example.com")
+    assert len(commits) == 1
+    assert len(callback_calls) == 1
@@ -0,0 +1,223 @@
+"""Benchmarks of the hot database access paths.
+
+They seed large tables and are slow, so they are skipped unless the
+``TAHRIR_BENCHMARKS`` environment variable is set:
+
+    TAHRIR_BENCHMARKS=1 pytest -s tests/test_benchmarks.py
+"""
+
+import datetime
+import gc
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import pygments
+import pygments.formatters
+import pygments.lexers
+import pytest
+import simplejson
+from sqlalchemy import insert
+
+from tahrir_api.model import Assertion, Badge, Issuer, Person, PYGMENTS_CACHE
+
+
+pytestmark = pytest.mark.skipif(
+    not os.environ.get("TAHRIR_BENCHMARKS"), reason="Set TAHRIR_BENCHMARKS=1 to run benchmarks"
+)
+
+
+def seed_assertions(api, persons=10_000, badges=100):
+    """Insert ``persons * badges`` assertions, bypassing the API for speed."""
+    connection = api.session.connection()
+    now = datetime.datetime(2024, 1, 1)
+    connection.execute(
+        insert(Issuer), [dict(origin="o", name="n", org="o", contact="c", created_on=now)]
+    )
+    connection.execute(
+        insert(Badge),
+        [
+            dict(
+                id=f"badge-{b}",
+                name=f"Badge {b}",
+                image="i",
+                description="d",
+                criteria="c",
+                issuer_id=1,
+                created_on=now,
+            )
+            for b in range(badges)
+        ],
+    )
+    connection.execute(
+        insert(Person),
+        [
+            dict(id=p, email=f"user{p}@example.com", nickname=f"user{p}", created_on=now)
+            for p in range(1, persons + 1)
+        ],
+    )
+    for b in range(badges):
+        connection.execute(
+            insert(Assertion),
+            [
+                dict(
+                    id=f"badge-{b} -> {p}",
+                    badge_id=f"badge-{b}",
+                    person_id=p,
+                    salt="s",
+                    recipient="r",
+                    issued_on=now + datetime.timedelta(minutes=b * persons + p),
+                )
+                for p in range(1, persons + 1)
+            ],
+        )
+    api.session.commit()
+
+
+def timed(func, *args, repeat=20):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(*args)
+    return (time.perf_counter() - start) / repeat
+
+
+def query_plan(api, query, label):
+    query = str(query.statement.compile(compile_kwargs={"literal_binds": True}))
+    # The label keeps SQLite from reusing a plan prepared before a schema change.
+    plan = api.session.connection().exec_driver_sql(f"EXPLAIN QUERY PLAN {query} -- {label}")
+    return " ".join(row[-1] for row in plan)
+
+
+INDEXES = [
+    "ix_assertions_person_id_issued_on",
+    "ix_assertions_badge_id_issued_on",
+    "ix_assertions_issued_on",
+]
+
+
+def test_assertion_indexes(api):
+    seed_assertions(api)
+    start = datetime.datetime(2024, 1, 2)
+    stop = datetime.datetime(2024, 1, 3)
+    by_person = api.session.query(Assertion).filter_by(person_id=5000)
+    by_badge = api.session.query(Assertion).filter_by(badge_id="badge-50")
+    by_date = api.session.query(Assertion).filter(
+        Assertion.issued_on >= start, Assertion.issued_on <= stop
+    )
+    queries = {
+        "by person": (by_person, by_person.all),
+        "by badge": (by_badge, by_badge.count),
+        "by date": (by_date, by_date.count),
+    }
+
+    indexed = {name: (query_plan(api, q, "indexed"), timed(f)) for name, (q, f) in queries.items()}
+    for index in Assertion.__table__.indexes:
+        if index.name in INDEXES:
+            index.drop(api.session.connection())
+    unindexed = {
+        name: (query_plan(api, q, "unindexed"), timed(f)) for name, (q, f) in queries.items()
+    }
+
+    for name in queries:
+        print(f"\n{name}:")
+        print(f"  with indexes:    {indexed[name][1] * 1000:8.2f}ms  {indexed[name][0]}")
+        print(f"  without indexes: {unindexed[name][1] * 1000:8.2f}ms  {unindexed[name][0]}")
+        assert "USING INDEX" in indexed[name][0]
+        assert "USING INDEX" not in unindexed[name][0]
+        assert indexed[name][1] < unindexed[name][1]
+
+
+def current_rss():
+    """Return the resident memory of the process, in bytes."""
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/statm"), reason="Needs /proc")
+def test_iter_all_assertions_memory(api):
+    seed_assertions(api)
+    api.session.expunge_all()
+    gc.collect()
+
+    samples = []
+    start = current_rss()
+    for count, _row in enumerate(api.iter_all_assertions(page_size=1000, rows=True), 1):
+        if count % 100_000 == 0:
+            samples.append(current_rss() - start)
+    assert count == 1_000_000
+    streamed_objects = 0
+    for count, _assertion in enumerate(api.iter_all_assertions(page_size=1000), 1):
+        if count % 100_000 == 0:
+            streamed_objects = max(streamed_objects, current_rss() - start)
+
+    gc.collect()
+    start = current_rss()
+    assertions = api.get_all_assertions().all()
+    loaded = current_rss() - start
+    del assertions
+
+    print("\nRSS growth over 1M assertions, in MB:")
+    print(f"  iter_all_assertions(rows=True): {[round(s / 2**20) for s in samples]}")
+    print(f"  iter_all_assertions():          {streamed_objects / 2**20:8.1f}")
+    print(f"  get_all_assertions().all():     {loaded / 2**20:8.1f}")
+    # The memory doesn't grow with the number of rows read.
+    assert samples[-1] - samples[0] < 16 * 2**20
+    assert streamed_objects < loaded / 10
+
+
+def render_uncached(assertion):
+    """Render an assertion like __pygments__ did before its renderers were shared and cached."""
+    return pygments.highlight(
+        simplejson.encoder.JSONEncoder(indent=2).encode(assertion.as_dict()),
+        pygments.lexers.JavascriptLexer(),
+        pygments.formatters.HtmlFormatter(full=False),
+    ).strip()
+
+
+def test_assertion_pygments(api):
+    issuer_id = api.add_issuer("TestOrigin", "TestName", "TestOrg", "TestContact")
+    api.add_badge("TestBadge", "TestImage", "A test badge", "TestCriteria", issuer_id)
+    api.add_person("alice@example.com")
+    api.add_assertion("testbadge", "alice@example.com", None)
+    assertion = api.get_all_assertions().one()
+    PYGMENTS_CACHE.clear()
+    assert assertion.__pygments__() == render_uncached(assertion)
+
+    uncached = timed(render_uncached, assertion, repeat=200)
+    cached = timed(assertion.__pygments__, repeat=200)
+    print("\nAssertion.__pygments__:")
+    print(f"  before:  {uncached * 1000:8.3f}ms")
+    print(f"  cached:  {cached * 1000:8.3f}ms")
+    assert cached < uncached / 5
+
+
+# The seconds allowed to import tahrir_api.dbapi, which short-lived jobs pay on each start.
+IMPORT_TIME_BUDGET = 0.75
+
+
+def import_time(module):
+    """Return the seconds spent importing a module in a new interpreter."""
+    result = subprocess.run(  # noqa: S603
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    for line in result.stderr.splitlines():
+        _self, cumulative, name = line.split("|")
+        if name.strip() == module:
+            return int(cumulative) / 1_000_000
+    raise ValueError(f"{module} was not imported")
+
+
+def test_import_time():
+    times = {
+        module: min(import_time(module) for _ in range(5))
+        for module in ("tahrir_api.model", "tahrir_api.dbapi")
+    }
+    print("\nImport time:")
+    for module, seconds in times.items():
+        print(f"  {module}: {seconds * 1000:8.1f}ms")
+    assert times["tahrir_api.dbapi"] < IMPORT_TIME_BUDGET
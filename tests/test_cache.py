@@ -0,0 +1,326 @@
+import socketserver
+import threading
+from datetime import datetime
+
+import pytest
+
+from tahrir_api.cache import LRUCache, MemcachedBackend, MemoryBackend
+from tahrir_api.dbapi import TahrirDatabase
+
+
+@pytest.fixture
+def cache():
+    return LRUCache(maxsize=10)
+
+
+class MemcachedHandler(socketserver.StreamRequestHandler):
+    """A stand-in for a memcached server, implementing what the backend uses."""
+
+    def handle(self):
+        values = self.server.values
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command, key, *args = line.decode().split()
+            if command in ("set", "add"):
+                data = self.rfile.read(int(args[2]) + 2)[:-2]
+                if command == "add" and key in values:
+                    self.wfile.write(b"NOT_STORED\r\n")
+                    continue
+                values[key] = data
+                self.wfile.write(b"STORED\r\n")
+            elif command == "get":
+                if key in values:
+                    self.wfile.write(
+                        b"VALUE %s 0 %d\r\n%s\r\n" % (key.encode(), len(values[key]), values[key])
+                    )
+                self.wfile.write(b"END\r\n")
+            elif command == "incr":
+                if key not in values:
+                    self.wfile.write(b"NOT_FOUND\r\n")
+                    continue
+                values[key] = str(int(values[key]) + int(args[0])).encode()
+                self.wfile.write(values[key] + b"\r\n")
+            elif command == "delete":
+                self.wfile.write(b"DELETED\r\n" if values.pop(key, None) else b"NOT_FOUND\r\n")
+
+
+@pytest.fixture
+def memcached():
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), MemcachedHandler)
+    server.daemon_threads = True
+    server.values = {}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(params=["memory", "memcached"])
+def backend(request):
+    if request.param == "memory":
+        return MemoryBackend()
+    server = request.getfixturevalue("memcached")
+    return MemcachedBackend(*server.server_address)
+
+
+@pytest.fixture
+def shared_api(api, backend):
+    return TahrirDatabase(session=api.session, shared_cache=backend)
+
+
+@pytest.fixture
+def other_api(api, backend):
+    """Another API instance on the same database, sharing the cache."""
+    other = TahrirDatabase(dburi=str(api.session.get_bind().url), shared_cache=backend)
+    yield other
+    other.session.close()
+
+
+def seed(api):
+    issuer_id = api.add_issuer("TestOrigin", "TestName", "TestOrg", "TestContact")
+    api.add_badge("TestBadge", "TestImage", "A test badge", "TestCriteria", issuer_id)
+    api.add_badge("OtherBadge", "TestImage", "Another badge", "TestCriteria", issuer_id)
+    api.add_person("alice@example.com")
+    api.add_person("bob@example.com")
+    api.add_assertion("testbadge", "alice@example.com", datetime(2024, 1, 1))
+
+
+@pytest.fixture
+def cached_api(api, cache):
+    api.cache = cache
+    return api
+
+
+def test_lru_cache_eviction():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    # "b" was the least recently used entry
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats == {"hits": 3, "misses": 1, "size": 2}
+
+
+def test_lru_cache_ttl(clock):
+    cache = LRUCache(ttl=10, clock=clock)
+    cache.set("a", 1)
+    clock.now = 9
+    assert cache.get("a") == 1
+    clock.now = 10
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_cached_badge(cached_api, cache, statements):
+    issuer_id = cached_api.add_issuer("TestOrigin", "TestName", "TestOrg", "TestContact")
+    cached_api.add_badge("TestBadge", "TestImage", "A test badge", "TestCriteria", issuer_id)
+
+    statements.clear()
+    misses = cache.misses
+    badge = cached_api.get_badge("TestBadge")
+    assert len(statements) == 1
+    assert cache.misses == misses + 1
+
+    # Hits don't query the database, even after a commit expired the objects.
+    cached_api.session.commit()
+    statements.clear()
+    hits = cache.hits
+    assert cached_api.get_badge("testbadge") is badge
+    assert cached_api.badge_exists("testbadge")
+    assert badge.name == "TestBadge"
+    assert statements == []
+    assert cache.hits == hits + 2
+
+    cached_api.delete_badge("testbadge")
+    assert cached_api.get_badge("testbadge") is None
+    assert not cached_api.badge_exists("testbadge")
+
+
+def test_cached_tagged_badge(cached_api, statements):
+    issuer_id = cached_api.add_issuer("TestOrigin", "TestName", "TestOrg", "TestContact")
+    cached_api.add_badge(
+        "TestBadge", "TestImage", "A test badge", "TestCriteria", issuer_id, tags="fedora,qa"
+    )
+    cached_api.add_person("alice@example.com")
+    badge = cached_api.get_badge("testbadge")
+    cached_api.session.commit()
+
+    statements.clear()
+    assert cached_api.get_badge("testbadge") is badge
+    assert cached_api.badge_exists("testbadge")
+    assert statements == []
+    assert cached_api.add_assertion("testbadge", "alice@example.com", None)
+    assert sorted(t.tag for t in badge.badge_tags) == ["fedora", "qa"]
+
+
+def test_cached_badge_pending_changes(cached_api):
+    issuer_id = cached_api.add_issuer("TestOrigin", "TestName", "TestOrg", "TestContact")
+    cached_api.add_badge("TestBadge", "TestImage", "A test badge", "TestCriteria", issuer_id)
+    badge = cached_api.get_badge("testbadge")
+    badge.description = "Changed"
+    # A hit doesn't overwrite the changes of the object in the session.
+    assert cached_api.get_badge("testbadge") is badge
+    assert badge.description == "Changed"
+    assert badge in cached_api.session.dirty
+    cached_api.session.commit()
+    cached_api.session.expire_all()
+    assert cached_api.get_badge("testbadge").description == "Changed"
+
+
+def test_cached_issuer(cached_api, cache, statements):
+    issuer_id = cached_api.add_issuer("TestOrigin", "TestName", "TestOrg", "TestContact")
+    assert str(cached_api.get_issuer(issuer_id)) == "TestName"
+
+    statements.clear()
+    assert str(cached_api.get_issuer(issuer_id)) == "TestName"
+    assert statements == []
+
+    cached_api.delete_issuer(issuer_id)
+    assert cached_api.get_issuer(issuer_id) is None
+
+
+def test_cached_team_and_series(cached_api, statements):
+    team_id = cached_api.create_team("TestTeam")
+    series_id = cached_api.create_series("TestSeries", "A test series", team_id)
+    cached_api.get_team("TestTeam")
+    cached_api.get_series("TestSeries")
+
+    statements.clear()
+    assert cached_api.get_team(team_id).name == "TestTeam"
+    assert cached_api.get_series(series_id).name == "TestSeries"
+    assert statements == []
+
+
+def test_backend(backend):
+    assert backend.get("key") is None
+    backend.set("key", "value")
+    assert backend.get("key") == "value"
+    assert backend.incr("version") == 1
+    assert backend.incr("version") == 2
+    assert backend.get("version") == "2"
+    backend.delete("key")
+    assert backend.get("key") is None
+
+
+def test_memory_backend_ttl(clock):
+    backend = MemoryBackend(clock=clock)
+    backend.set("key", "value", ttl=10)
+    clock.now = 10
+    assert backend.get("key") is None
+
+
+def test_memcached_backend_unavailable(memcached):
+    backend = MemcachedBackend(*memcached.server_address)
+    backend.set("key", "value")
+    memcached.shutdown()
+    memcached.server_close()
+    backend._close()
+    # Errors are cache misses.
+    assert backend.get("key") is None
+    assert backend.incr("version") is None
+    backend.set("key", "value")
+
+
+def test_shared_leaderboard(shared_api, other_api, statements):
+    seed(shared_api)
+    leaderboard = other_api.get_leaderboard()
+    assert [entry.nickname for entry in leaderboard] == ["alice"]
+
+    # The other instance uses the cached result.
+    statements.clear()
+    assert shared_api.get_leaderboard() == leaderboard
+    assert not any("rank()" in statement.lower() for statement in statements)
+
+    # Awarding a badge bumps the version.
+    shared_api.add_assertion("testbadge", "bob@example.com", datetime(2024, 1, 2))
+    shared_api.add_assertion("otherbadge", "bob@example.com", datetime(2024, 1, 3))
+    assert [entry.nickname for entry in other_api.get_leaderboard()] == ["bob", "alice"]
+
+
+def test_shared_leaderboard_windows(shared_api, other_api):
+    seed(shared_api)
+    start, stop = datetime(2024, 1, 2), datetime(2024, 1, 5)
+    assert other_api.get_leaderboard(start, stop) == []
+    assert other_api.get_leaderboard() != []
+    shared_api.add_assertion("testbadge", "bob@example.com", datetime(2024, 1, 3))
+    assert [entry.nickname for entry in other_api.get_leaderboard(start, stop)] == ["bob"]
+
+
+def test_shared_leaderboard_opt_out(shared_api, other_api):
+    seed(shared_api)
+    assert len(other_api.get_leaderboard()) == 1
+    context = other_api.get_rank_context(other_api.get_person("alice@example.com"))
+    assert context["rank"] == 1
+
+    shared_api.get_person("alice@example.com").opt_out = True
+    shared_api.session.commit()
+    assert other_api.get_leaderboard() == []
+    assert other_api.get_rank_context(other_api.get_person("alice@example.com")) is None
+
+
+def test_shared_leaderboard_rollback(shared_api, other_api, backend):
+    seed(shared_api)
+    versions = backend.get("tahrir:version:leaderboard")
+    shared_api.get_person("alice@example.com").opt_out = True
+    shared_api.session.flush()
+    shared_api.session.rollback()
+    assert backend.get("tahrir:version:leaderboard") == versions
+
+
+def test_shared_assertions_by_email(shared_api, other_api, statements):
+    seed(shared_api)
+    assertions = other_api.get_assertions_by_email("alice@example.com")
+    assert [a.badge_id for a in assertions] == ["testbadge"]
+
+    statements.clear()
+    cached = shared_api.get_assertions_by_email("alice@example.com")
+    assert len(statements) == 1  # the person lookup
+    assert [(a.id, a.issued_on, a.recipient) for a in cached] == [
+        (a.id, a.issued_on, a.recipient) for a in assertions
+    ]
+    assert cached[0].badge.name == "TestBadge"
+
+    shared_api.add_assertion("otherbadge", "alice@example.com", datetime(2024, 1, 2))
+    assert len(other_api.get_assertions_by_email("alice@example.com")) == 2
+    assert shared_api.get_assertions_by_email("bob@example.com") == []
+
+
+def test_shared_assertions_pending_changes(shared_api, other_api):
+    seed(shared_api)
+    other_api.get_assertions_by_email("alice@example.com")
+    (assertion,) = shared_api.get_all_assertions().all()
+    assertion.issued_for = "http://example.com/changed"
+    (cached,) = shared_api.get_assertions_by_email("alice@example.com")
+    assert cached is assertion
+    assert cached.issued_for == "http://example.com/changed"
+    assert assertion in shared_api.session.dirty
+
+
+def test_shared_bulk_assertions(shared_api, other_api):
+    seed(shared_api)
+    assert len(other_api.get_assertions_by_email("bob@example.com")) == 0
+    assert len(other_api.get_leaderboard()) == 1
+    shared_api.add_assertions([("testbadge", "bob@example.com"), ("otherbadge", "bob@example.com")])
+    assert len(other_api.get_assertions_by_email("bob@example.com")) == 2
+    assert other_api.get_leaderboard()[0].nickname == "bob"
+
+
+def test_shared_deletions(shared_api, other_api, backend):
+    seed(shared_api)
+    assert len(other_api.get_leaderboard()) == 1
+    assert len(other_api.get_assertions_by_email("alice@example.com")) == 1
+    shared_api.session.delete(shared_api.get_assertions_by_email("alice@example.com")[0])
+    shared_api.session.commit()
+    assert other_api.get_leaderboard() == []
+    assert other_api.get_assertions_by_email("alice@example.com") == []
+
+    bob = shared_api.get_person("bob@example.com")
+    version = backend.get(f"tahrir:version:person:{bob.id}")
+    shared_api.delete_person("bob@example.com")
+    assert backend.get(f"tahrir:version:person:{bob.id}") != version
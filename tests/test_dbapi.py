@@ -1,6 +1,10 @@
+import io
+import json
+from datetime import datetime
+
 import pytest
 
-from tahrir_api.model import Assertion
+from tahrir_api.model import Assertion, get_assertion_recipient, PYGMENTS_CACHE
 
 
 @pytest.fixture
@@ -153,6 +157,9 @@ def test_adjust_ranks(api, callback_calls, dummy_badge_id, dummy_person_id):
     api.session.flush()
 
     api.adjust_ranks(person)
+    # The notification is sent after the commit.
+    assert callback_calls == []
+    api.session.commit()
 
     # Ensure that we would have published a fedmsg messages for that.
     assert len(callback_calls) == 1
@@ -208,3 +215,359 @@ def test_get_badges_from_tags(api, dummy_issuer_id):
     assert len(badges_any) == 3
     badges_all = api.get_badges_from_tags(tags, match_all=True)
     assert len(badges_all) == 1
+
+
+def test_badge_count(api, dummy_issuer_id, dummy_badge_id, dummy_person_id):
+    other_badge_id = api.add_badge(
+        "OtherBadge", "TestImage", "Another test badge", "TestCriteria", dummy_issuer_id
+    )
+    person = api.get_person(dummy_person_id)
+    assert person.badge_count == 0
+
+    api.add_assertion(dummy_badge_id, dummy_person_id, None)
+    api.add_assertion(other_badge_id, dummy_person_id, None)
+    assert person.badge_count == 2
+
+    # Deleting an assertion through the session updates the count too.
+    api.session.delete(person.assertions[0])
+    api.session.flush()
+    assert person.badge_count == 1
+    api.session.expire(person)
+    assert person.badge_count == 1
+
+
+@pytest.mark.parametrize(
+    "getter,args",
+    [
+        ("get_badge", ("TestBadge",)),
+        ("get_badge", ("nobadge",)),
+        ("get_person", ("Test@Tester.com",)),
+        ("get_person", (None, 1)),
+        ("get_person", (None, None, "test")),
+        ("get_person_email", (1,)),
+        ("get_team", ("testteam",)),
+        ("get_series", ("testseries",)),
+        ("get_issuer", (1,)),
+        ("get_invitation", ("noinvitation",)),
+        ("badge_exists", ("testbadge",)),
+        ("person_exists", ("test@tester.com",)),
+        ("team_exists", ("testteam",)),
+        ("series_exists", ("testseries",)),
+    ],
+)
+def test_getters_single_query(api, statements, dummy_badge_id, dummy_person_id, getter, args):
+    team_id = api.create_team("TestTeam")
+    api.create_series("TestSeries", "A test series", team_id)
+    statements.clear()
+
+    getattr(api, getter)(*args)
+
+    assert len(statements) == 1
+    if getter.endswith("_exists"):
+        assert "EXISTS" in statements[0]
+        assert "count(" not in statements[0]
+
+
+@pytest.mark.parametrize(
+    "lookup,args,index",
+    [
+        ("badge_exists", ("TestBadge",), "ix_badges_lower_id"),
+        ("get_person", ("Test@Tester.com",), "ix_persons_lower_email"),
+        ("person_exists", (None, None, "Test"), "ix_persons_lower_nickname"),
+        ("team_exists", ("TestTeam",), "ix_team_lower_id"),
+        ("get_series", ("TestSeries",), "ix_series_lower_id"),
+        ("get_assertions_by_badge", ("TestBadge",), "ix_assertions_lower_badge_id"),
+    ],
+)
+def test_case_insensitive_lookups_use_index(api, statements, dummy_badge_id, lookup, args, index):
+    getattr(api, lookup)(*args)
+    query = statements[-1]
+
+    plan = (
+        api.session.connection()
+        .exec_driver_sql(f"EXPLAIN QUERY PLAN {query}", ("x",) * query.count("?"))
+        .all()
+    )
+    assert any(index in row[-1] for row in plan), plan
+
+
+def test_add_assertions(api, callback_calls, statements, dummy_issuer_id, dummy_badge_id):
+    other_badge_id = api.add_badge(
+        "OtherBadge", "TestImage", "Another test badge", "TestCriteria", dummy_issuer_id
+    )
+    for i in range(3):
+        api.add_person(f"test{i}@tester.com")
+    api.add_assertion(dummy_badge_id, "test0@tester.com", None)
+    callback_calls.clear()
+    statements.clear()
+
+    results = api.add_assertions(
+        [
+            (dummy_badge_id, "test0@tester.com"),  # already awarded
+            (dummy_badge_id, "Test1@Tester.com", None, "link"),
+            (other_badge_id, "test1@tester.com"),
+            (dummy_badge_id, "test2@tester.com"),
+            (dummy_badge_id, "test2@tester.com"),  # duplicate
+            ("nobadge", "test2@tester.com"),
+            (dummy_badge_id, "nobody@tester.com"),
+        ]
+    )
+
+    assert results == [
+        False,
+        ("Test1@Tester.com", dummy_badge_id),
+        ("test1@tester.com", other_badge_id),
+        ("test2@tester.com", dummy_badge_id),
+        False,
+        False,
+        False,
+    ]
+    # Persons, badges, existing assertions, insert, badge counts, counts by period
+    assert len(statements) == 6
+    assert len(callback_calls) == 3
+    assert callback_calls[0][0][0].body["user"]["username"] == "test1"
+
+    assert api.get_person("test1@tester.com").badge_count == 2
+    assert api.get_person("test2@tester.com").badge_count == 1
+    assertion = api.get_assertions_by_email("test1@tester.com")[0]
+    assert assertion.issued_for == "link"
+    assert assertion.recipient == get_assertion_recipient("test1@tester.com", assertion.salt)
+
+
+def test_add_assertion_statements(api, statements, dummy_issuer_id, dummy_person_id):
+    badge_ids = [
+        api.add_badge(f"TestBadge{i}", "TestImage", "A test badge", "TestCriteria", dummy_issuer_id)
+        for i in range(3)
+    ]
+    person = api.get_person(dummy_person_id)
+
+    # Without a recipient, the default looks up the email of each person.
+    statements.clear()
+    for badge_id in badge_ids[:2]:
+        api.session.add(Assertion(badge_id=badge_id, person_id=person.id))
+    api.session.flush()
+    assert len([s for s in statements if s.startswith("SELECT persons.email")]) == 2
+
+    # add_assertion() already knows the email: get_person, get_badge, insert, and the
+    # badge count and count by period updates.
+    statements.clear()
+    api.add_assertion(badge_ids[2], dummy_person_id, None)
+    assert len(statements) == 5
+    assert not any(s.startswith("SELECT persons.email") for s in statements)
+    assertion = api.get_assertions_by_badge(badge_ids[2])[0]
+    assert assertion.recipient == get_assertion_recipient(dummy_person_id, assertion.salt)
+
+
+@pytest.mark.parametrize(
+    "lookup,args,index",
+    [
+        ("get_assertions_by_email", ("test@tester.com",), "ix_assertions_person_id_issued_on"),
+        ("assertion_exists", ("testbadge", "test@tester.com"), "ix_assertions_"),
+        (
+            "get_leaderboard",
+            (datetime(2024, 3, 10, 12), datetime(2024, 3, 11, 12)),
+            "ix_assertions_issued_on",
+        ),
+    ],
+)
+def test_assertion_lookups_use_index(
+    api, statements, dummy_badge_id, dummy_person_id, lookup, args, index
+):
+    api.add_assertion(dummy_badge_id, dummy_person_id, None)
+    statements.clear()
+    getattr(api, lookup)(*args)
+    query = statements[-1]
+
+    plan = (
+        api.session.connection()
+        .exec_driver_sql(f"EXPLAIN QUERY PLAN {query}", ("x",) * query.count("?"))
+        .all()
+    )
+    assert any(index in row[-1] for row in plan), plan
+    assert not any(row[-1].startswith("SCAN assertions") for row in plan), plan
+
+
+def test_get_badges_from_tags_normalized(api, statements, dummy_issuer_id):
+    api.add_badge(
+        "BadgeA", "TestImage", "Tagged", "TestCriteria", dummy_issuer_id, tags="Fedora, QA,"
+    )
+    api.add_badge("BadgeB", "TestImage", "Tagged", "TestCriteria", dummy_issuer_id, tags="myqa")
+    assert [t.tag for t in api.get_badge("badgea").badge_tags] == ["fedora", "qa"]
+
+    statements.clear()
+    assert [b.id for b in api.get_badges_from_tags(["qa", "QA "])] == ["badgea"]
+    assert [b.id for b in api.get_badges_from_tags(["fedora", "qa"], match_all=True)] == ["badgea"]
+    assert api.get_badges_from_tags(["fedora", "myqa"], match_all=True) == []
+    assert len(statements) == 3
+
+
+def test_badge_tags_edited(api, dummy_issuer_id):
+    api.add_badge(
+        "BadgeA", "TestImage", "Tagged", "TestCriteria", dummy_issuer_id, tags="fedora, qa,"
+    )
+    badge = api.get_badge("badgea")
+    badge.tags = "QA, Design,"
+    api.session.commit()
+    api.session.expire_all()
+    assert sorted(t.tag for t in api.get_badge("badgea").badge_tags) == ["design", "qa"]
+    assert [b.id for b in api.get_badges_from_tags(["design"])] == ["badgea"]
+    assert api.get_badges_from_tags(["fedora"]) == []
+
+    api.get_badge("badgea").tags = None
+    api.session.commit()
+    assert api.get_badges_from_tags(["qa", "design"]) == []
+
+
+def test_get_badges_from_team(api, statements, dummy_issuer_id):
+    team_id = api.create_team("TestTeam")
+    api.create_team("EmptyTeam")
+    series_1 = api.create_series("Series1", "A test series", team_id)
+    series_2 = api.create_series("Series2", "Another test series", team_id)
+    badge_ids = [
+        api.add_badge(f"TestBadge{i}", "TestImage", "A test badge", "TestCriteria", dummy_issuer_id)
+        for i in range(4)
+    ]
+    api.create_milestone(2, badge_ids[0], series_1)
+    api.create_milestone(1, badge_ids[1], series_1)
+    api.create_milestone(1, badge_ids[2], series_2)
+    api.create_milestone(2, badge_ids[1], series_2)
+
+    statements.clear()
+    badges = api.get_badges_from_team("TestTeam", ordered=True)
+    assert len(statements) == 1
+    assert [badge.id for badge in badges] == [badge_ids[1], badge_ids[0], badge_ids[2]]
+    assert sorted(badge.id for badge in api.get_badges_from_team(team_id)) == badge_ids[:3]
+    assert api.get_badges_from_team("emptyteam") == []
+    assert api.get_badges_from_team("noteam") is None
+
+
+def test_serialize_assertions(api, statements, dummy_issuer_id, dummy_person_id):
+    other_issuer_id = api.add_issuer("OtherOrigin", "OtherName", "OtherOrg", "OtherContact")
+    for i in range(6):
+        badge_id = api.add_badge(
+            f"TestBadge{i}",
+            "TestImage",
+            "A test badge",
+            "TestCriteria",
+            other_issuer_id if i % 2 else dummy_issuer_id,
+        )
+        api.add_assertion(badge_id, dummy_person_id, None)
+    assertions = api.get_assertions_by_email(dummy_person_id)
+    expected = [assertion.as_dict() for assertion in assertions]
+    assert len(expected) == 6
+
+    # Lazy loading needs queries for each assertion, badge and issuer.
+    api.session.expire_all()
+    statements.clear()
+    assert [assertion.as_dict() for assertion in assertions] == expected
+    assert len(statements) == 14
+
+    api.session.expire_all()
+    statements.clear()
+    assert api.serialize_assertions(assertions) == expected
+    assert len(statements) == 2
+
+    api.session.expire_all()
+    statements.clear()
+    assertions = api.get_assertions_by_email(dummy_person_id, load="full")
+    assert [assertion.as_dict() for assertion in assertions] == expected
+    # get_person, the assertions, then the badges joined with their issuers
+    assert len(statements) == 3
+
+
+def test_get_all_milestones_full(api, statements, dummy_issuer_id):
+    team_id = api.create_team("TestTeam")
+    series_id = api.create_series("TestSeries", "A test series", team_id)
+    for i in range(3):
+        badge_id = api.add_badge(
+            f"TestBadge{i}", "TestImage", "A test badge", "TestCriteria", dummy_issuer_id
+        )
+        api.create_milestone(i, badge_id, series_id)
+
+    statements.clear()
+    milestones = api.get_all_milestones(series_id, load="full")
+    assert len([milestone.as_dict() for milestone in milestones]) == 3
+    assert len(statements) == 2
+
+    with pytest.raises(ValueError):
+        api.get_all_milestones(series_id, load="everything")
+
+
+def test_iter_all(api, statements, dummy_badge_id):
+    for i in range(5):
+        api.add_person(f"user{i}@example.com")
+        api.add_assertion(dummy_badge_id, f"user{i}@example.com", None)
+    api.add_person("optout@example.com")
+    api.get_person("optout@example.com").opt_out = True
+    api.session.commit()
+
+    expected = [assertion.id for assertion in api.get_all_assertions().order_by("id")]
+    statements.clear()
+    assert [assertion.id for assertion in api.iter_all_assertions(page_size=2)] == expected
+    # Three pages, the last one is short
+    assert len(statements) == 3
+    assert "WHERE assertions.id > ?" in statements[1]
+
+    persons = [row.email for row in api.iter_all_persons(page_size=2, rows=True)]
+    assert persons == [f"user{i}@example.com" for i in range(5)]
+    assert len(list(api.iter_all_persons(include_opted_out=True))) == 6
+    assert [badge.id for badge in api.iter_all_badges()] == [dummy_badge_id]
+    assert list(api.iter_all_invitations()) == []
+
+    with pytest.raises(ValueError):
+        next(api.iter_all_badges(page_size=0))
+
+
+def test_export_assertions(api, statements, dummy_issuer_id, dummy_person_id):
+    other_issuer_id = api.add_issuer("OtherOrigin", "OtherName", "OtherOrg", "OtherContact")
+    other_person_id = api.add_person("other@tester.com")
+    for i in range(4):
+        badge_id = api.add_badge(
+            f"TestBadge{i}",
+            "http://example.com/badge.png" if i == 3 else "TestImage",
+            "A test badge",
+            "TestCriteria",
+            other_issuer_id if i % 2 else dummy_issuer_id,
+            tags="test,badge" if i else None,
+        )
+        api.add_assertion(badge_id, dummy_person_id, None)
+        api.add_assertion(badge_id, other_person_id, None)
+    assertions = api.get_all_assertions().order_by(Assertion.id).all()
+    expected = [assertion.as_dict() for assertion in assertions]
+
+    statements.clear()
+    assert list(api.iter_assertion_dicts(page_size=3)) == expected
+    assert len(statements) == 1
+
+    person_id = api.get_person(dummy_person_id).id
+    assert list(api.iter_assertion_dicts(person_id=person_id)) == [
+        assertion.as_dict() for assertion in assertions if assertion.person_id == person_id
+    ]
+    assert list(api.iter_assertion_dicts(badge_id="testbadge2")) == [
+        assertion.as_dict() for assertion in assertions if assertion.badge_id == "testbadge2"
+    ]
+
+    output = io.StringIO()
+    assert api.export_assertions(output) == 8
+    lines = output.getvalue().splitlines()
+    assert [json.loads(line) for line in lines] == expected
+    assert api.export_assertions(io.StringIO(), badge_id="missing") == 0
+
+
+def test_assertion_pygments(api, dummy_badge_id, dummy_person_id):
+    api.add_assertion(dummy_badge_id, dummy_person_id, datetime(2024, 1, 1))
+    assertion = api.get_all_assertions().one()
+    PYGMENTS_CACHE.clear()
+
+    html = assertion["pygments"]
+    assert html.startswith('<div class="highlight">')
+    assert "TestBadge" in html
+    assert assertion.__pygments__() == html
+    assert PYGMENTS_CACHE.stats["size"] == 1
+
+    # The rendering follows the changes of the badge.
+    api.get_badge(dummy_badge_id).name = "RenamedBadge"
+    renamed = assertion.__pygments__()
+    assert "RenamedBadge" in renamed
+    assert "TestBadge" not in renamed
+    assert PYGMENTS_CACHE.stats["size"] == 2
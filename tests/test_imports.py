@@ -0,0 +1,48 @@
+import subprocess
+import sys
+
+import pytest
+
+
+# Slow to import, and only needed to render assertions or send notifications.
+# Pygments is missing: alembic's templates (mako) import it anyway.
+DEFERRED = ["arrow", "simplejson", "tahrir_messages", "fedora_messaging"]
+
+
+@pytest.mark.parametrize(
+    "module", ["tahrir_api.model", "tahrir_api.dbapi", "tahrir_api.aio", "tahrir_api.outbox"]
+)
+def test_deferred_imports(module):
+    code = f"import sys, {module}; print(' '.join(sorted(sys.modules)))"
+    result = subprocess.run(  # noqa: S603
+        [sys.executable, "-c", code], capture_output=True, text=True
+    )
+    assert result.returncode == 0, result.stderr
+    imported = result.stdout.split()
+    assert [name for name in DEFERRED if name in imported] == []
+
+
+def test_deferred_imports_without_notifications(tmp_path):
+    # Without a notification callback, awarding badges doesn't build messages.
+    code = f"""
+import sys
+from tahrir_api.dbapi import TahrirDatabase
+from tahrir_api.utils import get_db_manager_from_uri
+
+uri = "sqlite:///{tmp_path.as_posix()}/testdb.db"
+get_db_manager_from_uri(uri).sync()
+api = TahrirDatabase(uri)
+issuer_id = api.add_issuer("TestOrigin", "TestName", "TestOrg", "TestContact")
+badge_id = api.add_badge("TestBadge", "TestImage", "A test badge", "TestCriteria", issuer_id)
+api.add_person("alice@example.com")
+api.add_assertion(badge_id, "alice@example.com", None)
+api.adjust_ranks(api.get_person("alice@example.com"))
+api.session.commit()
+print(" ".join(sorted(sys.modules)))
+"""
+    result = subprocess.run(  # noqa: S603
+        [sys.executable, "-c", code], capture_output=True, text=True
+    )
+    assert result.returncode == 0, result.stderr
+    imported = result.stdout.split()
+    assert [name for name in DEFERRED if name in imported] == []
@@ -0,0 +1,106 @@
+import sqlite3
+import threading
+
+from tahrir_api.dbapi import TahrirDatabase
+
+
+def make_api(api, **kwargs):
+    return TahrirDatabase(dburi=str(api.session.get_bind().url), **kwargs)
+
+
+def test_notifications_after_commit(api, badge):
+    database = api.session.get_bind().url.database
+    committed = []
+
+    def callback(message):
+        # The award is visible to other connections when the message is sent.
+        with sqlite3.connect(database) as connection:
+            committed.append(connection.execute("SELECT COUNT(*) FROM assertions").fetchone()[0])
+
+    api.notification_callback = callback
+    api.add_person("alice@example.com")
+    api.add_assertion(badge, "alice@example.com", None)
+    assert committed == [1]
+
+
+def test_notifications_manual_commit(api, badge, callback_calls):
+    api.add_person("alice@example.com")
+    api.autocommit = False
+    api.add_assertion(badge, "alice@example.com", None)
+    api.note_login("alice@example.com")
+    assert callback_calls == []
+    api.session.commit()
+    assert [type(args[0]).__name__ for args, kwargs in callback_calls] == [
+        "BadgeAwardV1",
+        "PersonLoginFirstV1",
+    ]
+
+
+def test_notifications_rollback(api, badge, callback_calls):
+    api.add_person("alice@example.com")
+    api.autocommit = False
+    api.add_assertion(badge, "alice@example.com", None)
+    api.session.rollback()
+    api.session.commit()
+    assert callback_calls == []
+
+
+def test_notifications_background(api, badge):
+    api.add_person("alice@example.com")
+    api.add_person("bob@example.com")
+    messages = []
+    thread_names = set()
+
+    def callback(message):
+        thread_names.add(threading.current_thread().name)
+        messages.append(message)
+
+    background = make_api(
+        api, notification_callback=callback, notification_workers=1, notification_batch_size=2
+    )
+    with background.batch():
+        background.add_assertion(badge, "alice@example.com", None)
+        background.add_assertion(badge, "bob@example.com", None)
+        background.note_login("alice@example.com")
+    assert background.wait_for_notifications(timeout=10)
+    assert len(messages) == 3
+    assert all(name.startswith("tahrir-notifications") for name in thread_names)
+    background.close()
+
+
+def test_notifications_background_errors(api, badge, caplog):
+    api.add_person("alice@example.com")
+
+    def callback(message):
+        raise RuntimeError("The broker is down")
+
+    background = make_api(api, notification_callback=callback, notification_workers=2)
+    assert background.add_assertion(badge, "alice@example.com", None) == (
+        "alice@example.com",
+        badge,
+    )
+    background.close()
+    assert "Could not send the notification" in caplog.text
+
+
+def test_notifications_errors(api, badge, caplog):
+    api.add_person("alice@example.com")
+    api.add_person("bob@example.com")
+    sent = []
+
+    def callback(message):
+        if not sent:
+            sent.append(None)
+            raise RuntimeError("The broker is down")
+        sent.append(message)
+
+    api.notification_callback = callback
+    with api.batch():
+        api.add_assertion(badge, "alice@example.com", None)
+        api.add_assertion(badge, "bob@example.com", None)
+    assert "Could not send the notification" in caplog.text
+    # The other message of the commit was sent, and the session still works.
+    assert [message.body["user"]["username"] for message in sent[1:]] == ["bob"]
+    assert api.get_person("alice@example.com").badge_count == 1
+    api.note_login("alice@example.com")
+    assert len(sent) == 3
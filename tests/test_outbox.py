@@ -0,0 +1,102 @@
+import pytest
+from click.testing import CliRunner
+from tahrir_messages import BadgeAwardV1, PersonLoginFirstV1
+
+from tahrir_api.dbapi import TahrirDatabase
+from tahrir_api.model import OutboxMessage
+from tahrir_api.outbox import drain_outbox, MemoryPublisher
+from tahrir_api.scripts.drain_outbox import main
+
+
+PUBLISHER = MemoryPublisher()
+
+
+def get_publisher():
+    return PUBLISHER
+
+
+class FailingPublisher(MemoryPublisher):
+    def publish(self, messages):
+        raise ConnectionError("The broker is down")
+
+
+@pytest.fixture
+def outbox_api(api):
+    outbox_api = TahrirDatabase(session=api.session, outbox=True)
+    issuer_id = outbox_api.add_issuer("TestOrigin", "TestName", "TestOrg", "TestContact")
+    outbox_api.add_badge("TestBadge", "TestImage", "A test badge", "TestCriteria", issuer_id)
+    outbox_api.add_person("alice@example.com")
+    outbox_api.add_person("bob@example.com")
+    return outbox_api
+
+
+def pending(api):
+    return api.session.query(OutboxMessage).filter(OutboxMessage.sent_on.is_(None)).count()
+
+
+def test_outbox(outbox_api):
+    outbox_api.add_assertion("testbadge", "alice@example.com", None)
+    outbox_api.note_login("alice@example.com")
+    assert pending(outbox_api) == 2
+
+    publisher = MemoryPublisher()
+    assert drain_outbox(outbox_api.session, publisher, batch_size=1) == 2
+    assert [type(message) for message in publisher.messages] == [
+        BadgeAwardV1,
+        PersonLoginFirstV1,
+    ]
+    assert publisher.messages[0].body["user"]["username"] == "alice"
+    assert publisher.messages[0].body["badge"]["badge_id"] == "testbadge"
+    assert publisher.messages[0].topic == "badges.badge.award"
+    assert pending(outbox_api) == 0
+    assert drain_outbox(outbox_api.session, publisher) == 0
+    assert len(publisher.messages) == 2
+
+
+def test_outbox_bulk(outbox_api):
+    results = outbox_api.add_assertions(
+        [("testbadge", "alice@example.com"), ("testbadge", "bob@example.com")]
+    )
+    assert all(results)
+    assert pending(outbox_api) == 2
+    publisher = MemoryPublisher()
+    assert drain_outbox(outbox_api.session, publisher, limit=1) == 1
+    assert pending(outbox_api) == 1
+
+
+def test_outbox_rollback(outbox_api):
+    outbox_api.autocommit = False
+    outbox_api.add_assertion("testbadge", "alice@example.com", None)
+    outbox_api.session.rollback()
+    assert pending(outbox_api) == 0
+
+
+def test_outbox_publishing_failure(outbox_api):
+    outbox_api.add_assertion("testbadge", "alice@example.com", None)
+    with pytest.raises(ConnectionError):
+        drain_outbox(outbox_api.session, FailingPublisher())
+    assert pending(outbox_api) == 1
+
+
+def test_drain_outbox_script(outbox_api, tmp_path):
+    outbox_api.add_assertion("testbadge", "alice@example.com", None)
+    config = tmp_path / "config.py"
+    config.write_text(f"SQLALCHEMY_DATABASE_URI = {str(outbox_api.session.get_bind().url)!r}\n")
+    PUBLISHER.messages.clear()
+
+    result = CliRunner().invoke(
+        main, [str(config), "--publisher", "tests.test_outbox:get_publisher"]
+    )
+    assert result.exit_code == 0, result.output
+    assert result.output == "Published 1 messages.\n"
+    assert len(PUBLISHER.messages) == 1
+    outbox_api.session.expire_all()
+    assert pending(outbox_api) == 0
+
+
+def test_drain_outbox_script_bad_publisher(tmp_path):
+    config = tmp_path / "config.py"
+    config.write_text("SQLALCHEMY_DATABASE_URI = 'sqlite://'\n")
+    result = CliRunner().invoke(main, [str(config), "--publisher", "tests.test_outbox:missing"])
+    assert result.exit_code == 2
+    assert "Can't load the publisher" in result.output
@@ -1,7 +1,10 @@
 import datetime
+from random import Random
 
 import pytest
+from sqlalchemy import event, text
 
+from tahrir_api import model
 from tahrir_api.model import Assertion
 
 
@@ -118,9 +121,13 @@ def test_ranking_preexisting(api, test_data):
     # have a null-rank.
     assert person1.rank is None
 
-    # But once *anyone* else gets a badge, old ranks should be updated too.
+    # Adjusting the ranks when anyone else gets a badge doesn't fill them in,
+    # that's a one-off repair done by rebuilding the ranks.
     api.add_assertion(test_data["badge_1"], test_data["email_2"], None)
     api.adjust_ranks(person2)
+    assert person1.rank is None
+    assert person2.rank == 2
+    api.rebuild_ranks()
     assert person1.rank == 1
     assert person2.rank == 2
 
@@ -154,3 +161,273 @@ def test_ranking_with_time_limits(api, test_data):
     results = api.make_leaderboard(one_month_ago - epsilon, now)
     assert results[person1]["badges"] == 1
     assert results[person4]["badges"] == 3
+
+
+def test_ranking_incremental(api, test_data):
+    person1 = api.get_person(test_data["email_1"])
+    person2 = api.get_person(test_data["email_2"])
+    person3 = api.get_person(test_data["email_3"])
+
+    api.add_assertion(test_data["badge_1"], test_data["email_1"], None)
+    api.adjust_ranks(person1)
+    api.add_assertion(test_data["badge_1"], test_data["email_2"], None)
+    api.adjust_ranks(person2)
+    api.add_assertion(test_data["badge_1"], test_data["email_3"], None)
+    api.adjust_ranks(person3)
+    assert (person1.rank, person2.rank, person3.rank) == (1, 1, 1)
+
+    # Person 2 leaves the tie group, demoting the two others.
+    api.add_assertion(test_data["badge_2"], test_data["email_2"], None)
+    api.adjust_ranks(person2)
+    assert (person1.rank, person2.rank, person3.rank) == (2, 1, 2)
+
+    # Person 3 joins person 2, only person 1 is demoted.
+    api.add_assertion(test_data["badge_2"], test_data["email_3"], None)
+    api.adjust_ranks(person3)
+    assert (person1.rank, person2.rank, person3.rank) == (3, 1, 1)
+
+    assert api.rebuild_ranks(verify=True) == {}
+
+
+def test_ranking_bulk(api, test_data):
+    api.add_assertion(test_data["badge_1"], test_data["email_1"], None)
+    api.add_assertion(test_data["badge_1"], test_data["email_2"], None)
+    api.add_assertion(test_data["badge_1"], test_data["email_3"], None)
+    api.add_assertion(test_data["badge_2"], test_data["email_3"], None)
+    person1, person2, person3 = (api.get_person(test_data[f"email_{i}"]) for i in range(1, 4))
+    for person in (person1, person2, person3):
+        api.adjust_ranks(person)
+    assert (person1.rank, person2.rank, person3.rank) == (2, 2, 1)
+
+    # Person 1 passes both person 2 and person 3 at once.
+    api.add_assertions(
+        [
+            (test_data["badge_2"], test_data["email_1"]),
+            (test_data["badge_3"], test_data["email_1"]),
+        ]
+    )
+    api.adjust_ranks(person1)
+    assert (person1.rank, person2.rank, person3.rank) == (1, 3, 2)
+    assert api.rebuild_ranks(verify=True) == {}
+
+
+def test_ranking_bulk_rollback(api, test_data):
+    person1 = api.get_person(test_data["email_1"])
+    person2 = api.get_person(test_data["email_2"])
+    api.add_assertion(test_data["badge_1"], test_data["email_2"], None)
+    api.adjust_ranks(person2)
+
+    api.add_assertion(test_data["badge_1"], test_data["email_1"], None)
+    api.add_assertion(test_data["badge_2"], test_data["email_1"], None)
+    api.add_assertion(test_data["badge_3"], test_data["email_1"], None)
+    # The rolled back adjustment must not lose the three awards.
+    api.adjust_ranks(person1)
+    api.rollback()
+    api.adjust_ranks(person1)
+    assert (person1.rank, person2.rank) == (1, 2)
+    assert api.rebuild_ranks(verify=True) == {}
+
+
+def test_ranks_after_other_changes(api, test_data):
+    random = Random(42)  # noqa: S311
+    emails = [f"user{i}@example.com" for i in range(8)]
+    for email in emails:
+        api.add_person(email)
+    badges = [test_data[f"badge_{i}"] for i in range(1, 4)]
+
+    for _ in range(150):
+        person = api.get_person(random.choice(emails))
+        action = random.random()
+        if action < 0.6:
+            badge = random.choice(badges)
+            if not api.assertion_exists(badge, person.email):
+                api.add_assertion(badge, person.email, None)
+                api.adjust_ranks(person)
+        elif action < 0.8:
+            person.opt_out = not person.opt_out
+            api.session.commit()
+        elif person.assertions:
+            api.session.delete(random.choice(person.assertions))
+            api.session.commit()
+        assert api.rebuild_ranks(verify=True) == {}
+
+
+def test_rebuild_ranks(api, test_data):
+    api.add_assertion(test_data["badge_1"], test_data["email_1"], None)
+    api.add_assertion(test_data["badge_1"], test_data["email_2"], None)
+    api.add_assertion(test_data["badge_2"], test_data["email_2"], None)
+    person1 = api.get_person(test_data["email_1"])
+    person2 = api.get_person(test_data["email_2"])
+
+    assert api.rebuild_ranks(verify=True) == {person1: (None, 2), person2: (None, 1)}
+    assert person1.rank is None
+
+    api.rebuild_ranks()
+    assert person1.rank == 2
+    assert person2.rank == 1
+    assert api.rebuild_ranks(verify=True) == {}
+
+
+def test_get_leaderboard(api, test_data):
+    api.add_assertion(test_data["badge_1"], test_data["email_1"], one_month_ago)
+    api.add_assertion(test_data["badge_1"], test_data["email_2"], yesterday)
+    api.add_assertion(test_data["badge_2"], test_data["email_2"], one_month_ago)
+    api.add_assertion(test_data["badge_1"], test_data["email_3"], yesterday)
+    api.add_assertion(test_data["badge_2"], test_data["email_3"], yesterday)
+
+    leaderboard = api.get_leaderboard()
+    assert [tuple(row) for row in leaderboard] == [
+        (2, "test_2", 2, 1),
+        (3, "test_3", 2, 1),
+        (1, "test_1", 1, 3),
+    ]
+    expected = {
+        person.id: (data["badges"], data["rank"]) for person, data in api.make_leaderboard().items()
+    }
+    assert {row.person_id: (row.badges, row.rank) for row in leaderboard} == expected
+
+    page = api.get_leaderboard(limit=1, offset=1)
+    assert [tuple(row) for row in page] == [(3, "test_3", 2, 1)]
+
+    epsilon = datetime.timedelta(hours=1)
+    leaderboard = api.get_leaderboard(one_week_ago, now + epsilon)
+    assert [(row.nickname, row.badges, row.rank) for row in leaderboard] == [
+        ("test_3", 2, 1),
+        ("test_2", 1, 2),
+    ]
+
+
+@pytest.mark.parametrize("radius", [1, 2, 5])
+def test_get_rank_context(api, test_data, radius):
+    api.add_assertion(test_data["badge_1"], test_data["email_1"], None)
+    api.add_assertion(test_data["badge_1"], test_data["email_2"], None)
+    api.add_assertion(test_data["badge_2"], test_data["email_2"], None)
+    api.add_assertion(test_data["badge_1"], test_data["email_3"], None)
+    api.add_assertion(test_data["badge_2"], test_data["email_3"], None)
+    api.add_assertion(test_data["badge_1"], test_data["email_4"], None)
+    api.add_assertion(test_data["badge_2"], test_data["email_4"], None)
+    api.add_assertion(test_data["badge_3"], test_data["email_4"], None)
+
+    leaderboard = [tuple(row) for row in api.get_leaderboard()]
+    for index, (person_id, _nickname, badges, rank) in enumerate(leaderboard):
+        person = api.get_person(id=person_id)
+        context = api.get_rank_context(person, radius=radius)
+        assert context["rank"] == rank
+        assert context["badges"] == badges
+        assert context["above"] == leaderboard[max(0, index - radius) : index]
+        assert context["below"] == leaderboard[index + 1 : index + 1 + radius]
+
+
+def test_get_rank_context_statements(api, test_data, statements):
+    api.add_assertion(test_data["badge_1"], test_data["email_1"], None)
+    api.add_assertion(test_data["badge_1"], test_data["email_2"], None)
+    api.add_assertion(test_data["badge_2"], test_data["email_2"], None)
+    person = api.get_person(test_data["email_1"])
+    statements.clear()
+    assert api.get_rank_context(person)["rank"] == 2
+    # MySQL doesn't support aggregate filters.
+    assert not any("FILTER" in statement for statement in statements)
+    # The persons ahead are selected by their badge count only, which bounds the index scan.
+    assert "persons.badge_count >= ?" in statements[-1]
+    assert "persons.badge_count > ?" not in statements[-1]
+
+
+def test_get_rank_context_unranked(api, test_data):
+    api.add_assertion(test_data["badge_1"], test_data["email_1"], yesterday)
+    person1 = api.get_person(test_data["email_1"])
+    person2 = api.get_person(test_data["email_2"])
+
+    assert api.get_rank_context(person2) is None
+    assert api.get_rank_context(person1, start=one_month_ago, stop=one_week_ago) is None
+    context = api.get_rank_context(person1, start=one_week_ago, stop=now)
+    assert context == {"rank": 1, "badges": 1, "above": [], "below": []}
+
+
+def test_leaderboard_by_period(api, test_data):
+    day = datetime.datetime(2024, 3, 10)
+    issued = [
+        ("badge_1", "email_1", day + datetime.timedelta(hours=1)),
+        ("badge_2", "email_1", day + datetime.timedelta(days=2, hours=12)),
+        ("badge_3", "email_1", day + datetime.timedelta(days=5)),
+        ("badge_1", "email_2", day + datetime.timedelta(days=1, hours=23)),
+        ("badge_2", "email_2", day + datetime.timedelta(days=2)),
+        ("badge_1", "email_3", day + datetime.timedelta(days=3, hours=6)),
+    ]
+    for badge, email, issued_on in issued:
+        api.add_assertion(test_data[badge], test_data[email], issued_on)
+    # Deleted assertions are not counted anymore.
+    deleted = api.session.query(Assertion).filter_by(badge_id=test_data["badge_3"]).one()
+    api.session.delete(deleted)
+    api.session.flush()
+    issued.pop(2)
+
+    hours = [0, 1, 12, 24, 36, 47, 48, 72, 78, 120, 150]
+    for start_hour in hours:
+        for stop_hour in hours:
+            if start_hour > stop_hour:
+                continue
+            start = day + datetime.timedelta(hours=start_hour)
+            stop = day + datetime.timedelta(hours=stop_hour)
+            expected = {}
+            for _badge, email, issued_on in issued:
+                if start <= issued_on <= stop:
+                    nickname = test_data[email].split("@")[0]
+                    expected[nickname] = expected.get(nickname, 0) + 1
+            leaderboard = api.get_leaderboard(start, stop)
+            assert {row.nickname: row.badges for row in leaderboard} == expected, (start, stop)
+            assert {
+                person.nickname: data["badges"]
+                for person, data in api.make_leaderboard(start, stop).items()
+            } == expected
+
+
+@pytest.mark.parametrize("upsert", [True, False])
+def test_delete_person_after_their_assertions(api, test_data, monkeypatch, upsert):
+    if not upsert:
+        monkeypatch.setattr(model, "UPSERT_DIALECTS", {})
+    engine = api.session.get_bind()
+    event.listen(
+        engine,
+        "connect",
+        lambda connection, record: connection.execute("PRAGMA foreign_keys=ON"),
+    )
+    api.session.close()
+    engine.dispose()
+
+    day = datetime.datetime(2024, 3, 10, 12)
+    api.add_assertion(test_data["badge_1"], test_data["email_1"], day)
+    api.add_assertion(test_data["badge_2"], test_data["email_1"], day)
+    api.add_assertion(test_data["badge_1"], test_data["email_2"], day)
+    for assertion in api.get_assertions_by_email(test_data["email_1"]):
+        api.session.delete(assertion)
+    api.session.commit()
+
+    # The emptied days are deleted, they would keep the person from being deleted.
+    counts = api.session.query(model.AssertionCount.person_id, model.AssertionCount.count)
+    assert counts.all() == [(2, 1)]
+    assert api.delete_person(test_data["email_1"]) == test_data["email_1"]
+    assert api.session.execute(text("PRAGMA foreign_keys")).scalar() == 1
+
+
+@pytest.mark.parametrize("upsert", [True, False])
+def test_assertion_counts_by_period(api, test_data, monkeypatch, upsert):
+    if not upsert:
+        monkeypatch.setattr(model, "UPSERT_DIALECTS", {})
+    day = datetime.datetime(2024, 3, 10, 12)
+    api.add_assertion(test_data["badge_1"], test_data["email_1"], day)
+    api.add_assertions(
+        [
+            (test_data["badge_2"], test_data["email_1"], day),
+            (test_data["badge_3"], test_data["email_1"], day + datetime.timedelta(days=1)),
+            (test_data["badge_1"], test_data["email_2"], day),
+        ]
+    )
+
+    counts = api.session.query(
+        model.AssertionCount.person_id, model.AssertionCount.period, model.AssertionCount.count
+    ).order_by(model.AssertionCount.person_id, model.AssertionCount.period)
+    assert counts.all() == [
+        (1, datetime.date(2024, 3, 10), 2),
+        (1, datetime.date(2024, 3, 11), 1),
+        (2, datetime.date(2024, 3, 10), 1),
+    ]
@@ -0,0 +1,108 @@
+import shutil
+
+import pytest
+from sqlalchemy import event
+
+from tahrir_api.dbapi import TahrirDatabase
+
+
+@pytest.fixture
+def replica_api(api, tmp_path, monkeypatch, clock):
+    """An API reading from a copy of the database, which has a badge and two persons."""
+    issuer_id = api.add_issuer("TestOrigin", "TestName", "TestOrg", "TestContact")
+    api.add_badge("TestBadge", "TestImage", "A test badge", "TestCriteria", issuer_id)
+    api.add_person("alice@example.com")
+    api.add_person("bob@example.com")
+    api.session.close()
+    # The replica never catches up: it shows what was read from it.
+    shutil.copy(tmp_path / "testdb.db", tmp_path / "replica.db")
+
+    clock.now = 1000
+    monkeypatch.setattr("tahrir_api.dbapi.monotonic", clock)
+    replica_api = TahrirDatabase(
+        dburi=str(api.session.get_bind().url),
+        read_dburi=f"sqlite:///{tmp_path.as_posix()}/replica.db",
+        read_your_writes=5,
+    )
+    replica_api.clock = clock
+    yield replica_api
+    replica_api.close()
+
+
+def test_reads_from_replica(replica_api):
+    assert replica_api.add_assertion("testbadge", "alice@example.com", None)
+    # Right after the write, the reads stay on the primary.
+    assert len(replica_api.get_assertions_by_email("alice@example.com")) == 1
+    assert len(replica_api.get_all_assertions().all()) == 1
+    assert [p.nickname for p in replica_api.make_leaderboard()] == ["alice"]
+
+    replica_api.clock.now += 10
+    assert replica_api.get_assertions_by_email("alice@example.com") == []
+    assert replica_api.get_all_assertions().all() == []
+    assert replica_api.make_leaderboard() == {}
+    assert replica_api.get_leaderboard() == []
+    assert replica_api.get_assertions_by_badge("testbadge") == []
+    assert len(replica_api.get_all_persons().all()) == 2
+    assert [b.id for b in replica_api.get_all_badges()] == ["testbadge"]
+
+
+def test_use_primary(replica_api):
+    replica_api.add_assertion("testbadge", "alice@example.com", None)
+    replica_api.clock.now += 10
+    with replica_api.use_primary():
+        assert len(replica_api.get_assertions_by_email("alice@example.com")) == 1
+        assert replica_api.get_leaderboard()[0].nickname == "alice"
+    assert replica_api.get_leaderboard() == []
+
+
+def test_uncommitted_writes(replica_api):
+    replica_api.autocommit = False
+    replica_api.clock.now += 10
+    replica_api.add_assertion("testbadge", "alice@example.com", None)
+    assert len(replica_api.get_assertions_by_email("alice@example.com")) == 1
+    replica_api.rollback()
+    assert replica_api.get_assertions_by_email("alice@example.com") == []
+
+
+def test_lookups_use_primary(replica_api):
+    replica_api.add_person("carol@example.com")
+    replica_api.clock.now += 10
+    # The lookups back the writes, they are never read from the replica.
+    assert replica_api.person_exists(email="carol@example.com")
+    assert replica_api.get_person("carol@example.com").nickname == "carol"
+    assert replica_api.get_assertions_by_email("carol@example.com") is False
+
+
+def test_rebuild_ranks(replica_api):
+    replica_api.add_assertion("testbadge", "alice@example.com", None)
+    replica_api.session.commit()
+    replica_api.get_person("alice@example.com").rank = 42
+    replica_api.session.commit()
+    # The replica doesn't have the award, the ranks must be read from the primary.
+    replica_api.clock.now += 10
+    mismatches = replica_api.rebuild_ranks()
+    assert {person.email: ranks for person, ranks in mismatches.items()} == {
+        "alice@example.com": (42, 1)
+    }
+    replica_api.session.commit()
+    replica_api.session.expire_all()
+    assert replica_api.get_person("alice@example.com").rank == 1
+    assert replica_api.rebuild_ranks(verify=True) == {}
+
+
+def test_serialize_assertions(replica_api, tmp_path):
+    replica_api.add_assertion("testbadge", "alice@example.com", None)
+    replica_api.add_assertion("testbadge", "bob@example.com", None)
+    shutil.copy(tmp_path / "testdb.db", tmp_path / "replica.db")
+    replica_api.clock.now += 10
+    assertions = replica_api.get_all_assertions().all()
+    assert len(assertions) == 2
+
+    executed = []
+    engine = replica_api.read_session.get_bind()
+    event.listen(engine, "before_cursor_execute", lambda *args: executed.append(args[2]))
+    replica_api.read_session.expire_all()
+    serialized = replica_api.serialize_assertions(assertions)
+    assert [assertion["badge"]["name"] for assertion in serialized] == ["TestBadge"] * 2
+    # The assertions, then their badges with the issuers, all in the replica's session.
+    assert len(executed) == 2
@@ -0,0 +1,123 @@
+import gc
+import threading
+import weakref
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+
+from tahrir_api.dbapi import TahrirDatabase
+from tahrir_api.utils import get_db_manager_from_uri
+
+
+@pytest.fixture
+def db_uri(api):
+    return str(api.session.get_bind().url)
+
+
+def test_constructor_arguments(api, db_uri):
+    engine = create_engine(db_uri)
+    with pytest.raises(ValueError):
+        TahrirDatabase()
+    with pytest.raises(ValueError):
+        TahrirDatabase(dburi=db_uri, engine=engine)
+    with pytest.raises(ValueError):
+        TahrirDatabase(engine=engine, engine_options={"pool_size": 2})
+    with pytest.raises(ValueError):
+        TahrirDatabase(engine=engine).remove_session()
+
+
+def test_engine_options(db_uri):
+    api = TahrirDatabase(
+        dburi=db_uri, engine_options={"pool_size": 3, "max_overflow": 2, "pool_pre_ping": True}
+    )
+    pool = api.session.get_bind().pool
+    assert pool.size() == 3
+    assert pool._max_overflow == 2
+    assert pool._pre_ping
+    assert api.add_person("alice@example.com") == "alice@example.com"
+    api.close()
+
+
+def test_shared_engine(api, db_uri):
+    engine = create_engine(db_uri)
+    first = TahrirDatabase(engine=engine)
+    second = TahrirDatabase(engine=engine)
+    assert first.session is not second.session
+    assert first.session.get_bind() is second.session.get_bind() is engine
+    first.add_person("alice@example.com")
+    assert second.person_exists(email="alice@example.com")
+
+
+def test_scoped_sessions(api, db_uri, callback_calls):
+    def callback(message):
+        callback_calls.append(message)
+
+    scoped = TahrirDatabase(dburi=db_uri, scoped=True, notification_callback=callback)
+    issuer_id = scoped.add_issuer("TestOrigin", "TestName", "TestOrg", "TestContact")
+    scoped.add_badge("TestBadge", "TestImage", "A test badge", "TestCriteria", issuer_id)
+    scoped.add_person("alice@example.com")
+    scoped.add_person("bob@example.com")
+
+    in_batch = threading.Event()
+    awarded = threading.Event()
+    sessions = []
+    sent_in_batch = []
+
+    def worker():
+        sessions.append(scoped.session())
+        with scoped.batch():
+            in_batch.set()
+            # SQLite only has one writer at a time, award after the other thread.
+            awarded.wait(timeout=10)
+            scoped.add_assertion("testbadge", "alice@example.com", None)
+            sent_in_batch.extend(m.body["user"]["username"] for m in callback_calls)
+        scoped.remove_session()
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    in_batch.wait(timeout=10)
+    # This thread isn't in the batch, its calls are committed right away.
+    scoped.add_assertion("testbadge", "bob@example.com", None)
+    assert len(callback_calls) == 1
+    awarded.set()
+    thread.join(timeout=10)
+
+    assert sent_in_batch == ["bob"]
+    assert [m.body["user"]["username"] for m in callback_calls] == ["bob", "alice"]
+    assert sessions[0] is not scoped.session()
+    assert len(scoped.get_assertions_by_email("alice@example.com")) == 1
+    scoped.close()
+
+
+def test_statement_timeout(db_uri):
+    api = TahrirDatabase(dburi=db_uri, statement_timeout=0.1)
+    assert api.session.execute(text("SELECT 1")).scalar() == 1
+    slow = text(
+        "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < 1000000000) "
+        "SELECT count(*) FROM c"
+    )
+    with pytest.raises(OperationalError, match="interrupted"):
+        api.session.execute(slow)
+    api.session.rollback()
+    assert api.session.execute(text("SELECT 1")).scalar() == 1
+
+
+@pytest.mark.parametrize("scoped", [False, True])
+def test_listeners_released(api, db_uri, scoped):
+    session = get_db_manager_from_uri(db_uri).Session
+    if not scoped:
+        session = session()
+
+    def count_listeners():
+        # With a scoped session, they are on the class of its sessions.
+        return len(list((session() if scoped else session).dispatch.after_commit))
+
+    listeners = count_listeners()
+
+    closed = TahrirDatabase(session=session)
+    closed.close()
+    instances = [weakref.ref(TahrirDatabase(session=session)) for _ in range(100)]
+    gc.collect()
+    assert all(instance() is None for instance in instances)
+    assert count_listeners() == listeners